@@ -0,0 +1,45 @@
+"""Compare two results files of `benchmarks/run.py`.
+
+Exits with status 1 if any case got slower by more than the threshold.
+"""
+import argparse
+import json
+import sys
+
+
+def load_results(path):
+    with open(path) as f:
+        return json.load(f)['results']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('base', help='Results to compare against.')
+    parser.add_argument('new', help='Results to compare.')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='Fraction by which a case may get slower.')
+    args = parser.parse_args()
+
+    base, new = load_results(args.base), load_results(args.new)
+    slower = []
+    print(f'{"case":<20} {"base ms":>12} {"new ms":>12} {"ratio":>8}')
+    for name in sorted(set(base) & set(new)):
+        base_median = base[name]['median']
+        new_median = new[name]['median']
+        ratio = new_median / base_median
+        flag = ''
+        if ratio > 1 + args.threshold:
+            flag = '  slower'
+            slower.append(name)
+        elif ratio < 1 - args.threshold:
+            flag = '  faster'
+        print(f'{name:<20} {base_median * 1e3:12.3f} '
+              f'{new_median * 1e3:12.3f} {ratio:8.2f}{flag}')
+    for name in sorted(set(base) ^ set(new)):
+        print(f'{name:<20} only in {"base" if name in base else "new"}')
+    if slower:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+"""Check that importing the CLI stays within a time budget.
+
+Runs `python -X importtime -c "import nestler.nestler"` a few times, and
+exits with status 1 if the fastest import takes longer than the budget, or if
+any of the packages that should only be imported once used is imported.
+"""
+import argparse
+import os
+import re
+import subprocess
+import sys
+
+MODULE = 'nestler.nestler'
+
+# Import this checkout of nestler, without it needing to be installed.
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Packages that only some renders need, and that take a while to import.
+LAZY_MODULES = [
+    'IPython', 'ipykernel', 'jinja2', 'jupyter_client', 'matplotlib',
+    'pypandoc', 'pyparsing', 'yaml', 'zmq',
+]
+
+DEFAULT_BUDGET_MS = 300
+
+IMPORTTIME_RE = re.compile(
+    r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$', re.MULTILINE,
+)
+
+
+def measure(module):
+    """Return the cumulative import time of `module` in microseconds, and the
+    times of every module imported, from a fresh interpreter."""
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        capture_output=True, text=True, check=True, cwd=REPO_ROOT,
+        env=dict(os.environ, PYTHONDONTWRITEBYTECODE='1'),
+    )
+    times = {
+        name: int(cumulative)
+        for _, cumulative, _, name in IMPORTTIME_RE.findall(result.stderr)
+    }
+    return times[module], times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--budget', type=float, default=DEFAULT_BUDGET_MS,
+                        help='Most milliseconds the import may take.')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Number of imports to take the fastest of.')
+    parser.add_argument('--top', type=int, default=10,
+                        help='Number of the slowest imports to print, by '
+                             'cumulative time.')
+    args = parser.parse_args()
+
+    runs = [measure(MODULE) for _ in range(args.repeat)]
+    total, times = min(runs, key=lambda run: run[0])
+    print(f'{MODULE}: {total / 1e3:.1f} ms (budget {args.budget:.0f} ms)')
+    slowest = sorted((name for name in times if name != MODULE),
+                     key=times.get, reverse=True)
+    for name in slowest[:args.top]:
+        print(f'  {name:<30} {times[name] / 1e3:8.1f} ms')
+
+    failed = False
+    eager = sorted(
+        name for name in LAZY_MODULES
+        if any(imported == name or imported.startswith(f'{name}.')
+               for imported in times)
+    )
+    if eager:
+        print(f'Imported eagerly: {", ".join(eager)}')
+        failed = True
+    if total > args.budget * 1e3:
+        print('Over budget.')
+        failed = True
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,215 @@
+"""Time the phases of a render on synthetic documents, and save the results.
+
+Run from the repository root with `python benchmarks/run.py -o out.json`, and
+compare two result files with `benchmarks/compare.py`. Cases that need a
+package that isn't installed, such as matplotlib or pandas, are skipped, and
+the slowest cases, such as parsing 100 MB, only run with `--all`.
+`benchmarks/importtime.py` checks the time to import the CLI separately.
+"""
+import argparse
+import base64
+import fnmatch
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from collections import namedtuple
+from datetime import datetime, timezone
+
+# Import this checkout of nestler, without it needing to be installed.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from nestler import parseful as parse
+from nestler import execute
+from nestler import output_routines
+from nestler import nestler
+from nestler import parse_cache
+from nestler.constants import ChunkOption
+
+import synthetic
+
+# A case makes a function to time from a shared context, and says how many
+# times to call it, which packages it needs, and whether it only runs when
+# asked for.
+Case = namedtuple('Case', ['name', 'make', 'repeat', 'requires', 'opt_in'],
+                  defaults=[False])
+
+
+def _parse_case(n_bytes):
+    def make(ctx):
+        doc = synthetic.make_document_of_size(n_bytes)
+        return lambda: parse.parse(doc)
+    return make
+
+
+def _parse_cached_case(n_bytes):
+    def make(ctx):
+        doc_path = os.path.join(ctx.tmp_dir, 'cached.md')
+        with open(doc_path, 'w') as f:
+            f.write(synthetic.make_document_of_size(n_bytes))
+        store = parse_cache.ParseCache(os.path.join(ctx.tmp_dir, 'parsed'))
+
+        def parse_cached():
+            with open(doc_path) as f:
+                return store.parse_stream(f)
+        return parse_cached
+    return make
+
+
+def _exec_case(code, implicit_display):
+    def make(ctx):
+        client = ctx.client()
+        return lambda: execute.exec_code(client, code,
+                                         implicit_display=implicit_display)
+    return make
+
+
+def _render_chunk_case(outs):
+    def make(ctx):
+        options = nestler.get_global_options()
+        return lambda: output_routines.render_chunk(
+            'x = 1\n', options, dict(outs),
+            raise_errors=not options[ChunkOption.show_errors],
+        )
+    return make
+
+
+def _run_case(**doc_kwargs):
+    def make(ctx):
+        doc = synthetic.make_document(**doc_kwargs)
+        out_path_base = os.path.join(ctx.tmp_dir, 'doc')
+
+        def run():
+            with open(out_path_base + '.md', 'w') as f:
+                f.write(doc)
+            with open(out_path_base + '.md') as f:
+                nestler.run(f, out_path_base, connection_file=None)
+        return run
+    return make
+
+
+# An image payload of about 1 MB.
+IMAGE_OUTS = {'image': [{
+    'format': 'image/png',
+    'data': base64.b64encode(os.urandom(2 ** 20)).decode(),
+    'slug': None,
+    'caption': 'Noise',
+}]}
+
+TEXT_OUTS = {'text': ['\n'.join(f'line {i}' for i in range(1000))]}
+
+HTML_OUTS = {'html': [
+    '<table>'
+    + ''.join(f'<tr><td>{i}</td><td>{i / 3}</td></tr>' for i in range(10000))
+    + '</table>'
+]}
+
+CASES = [
+    Case('parse-1MB', _parse_case(2 ** 20), 5, ()),
+    Case('parse-10MB', _parse_case(10 * 2 ** 20), 1, ()),
+    Case('parse-100MB', _parse_case(100 * 2 ** 20), 1, (), opt_in=True),
+    Case('parse-cached-10MB', _parse_cached_case(10 * 2 ** 20), 5, ()),
+    Case('exec-statement', _exec_case('pass', False), 50, ()),
+    Case('exec-expression', _exec_case('1 + 1', True), 50, ()),
+    Case('render-chunk-text', _render_chunk_case(TEXT_OUTS), 50, ()),
+    Case('render-chunk-html', _render_chunk_case(HTML_OUTS), 50, ()),
+    Case('render-chunk-image', _render_chunk_case(IMAGE_OUTS), 20, ()),
+    Case('run-chunks', _run_case(n_chunks=50, n_inline=50), 3, ()),
+    Case('run-inline', _run_case(n_chunks=1, n_inline=300), 3, ()),
+    Case('run-prose', _run_case(n_chunks=5, n_inline=5,
+                                prose_bytes=2 ** 20), 3, ()),
+    Case('run-figures', _run_case(n_chunks=10, n_figures=10), 3,
+         ('matplotlib',)),
+    Case('run-dataframe', _run_case(n_chunks=2, df_rows=10000), 3,
+         ('pandas',)),
+    Case('run-table-styled', _run_case(n_chunks=2, df_rows=10000,
+                                       table_fmt='styled'), 3, ('pandas',)),
+    Case('run-table-plain', _run_case(n_chunks=2, df_rows=10000,
+                                      table_fmt='plain'), 3, ('pandas',)),
+    Case('run-table-paged', _run_case(n_chunks=2, df_rows=10000,
+                                      table_fmt='paged'), 3, ('pandas',)),
+]
+
+
+class Context:
+    """Things shared between cases, made when first needed."""
+
+    def __init__(self, tmp_dir):
+        self.tmp_dir = tmp_dir
+        self._client = None
+
+    def client(self):
+        if self._client is None:
+            self._client = execute.get_kernel_client()
+            execute.load_preamble(self._client)
+        return self._client
+
+    def close(self):
+        if self._client is not None:
+            execute.shutdown(self._client)
+
+
+def time_case(case, ctx):
+    func = case.make(ctx)
+    # Warm up, such as imports on the kernel.
+    func()
+    times = []
+    for _ in range(case.repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return {
+        'times': times,
+        'min': min(times),
+        'median': statistics.median(times),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-o', '--output', help='Path of the results file.')
+    parser.add_argument('-k', '--cases', default='*',
+                        help='Glob pattern of the names of cases to run.')
+    parser.add_argument('--all', action='store_true',
+                        help='Also run the slowest cases.')
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        ctx = Context(tmp_dir)
+        try:
+            for case in CASES:
+                if not fnmatch.fnmatch(case.name, args.cases):
+                    continue
+                if case.opt_in and not args.all:
+                    continue
+                missing = [name for name in case.requires
+                           if not synthetic.has_module(name)]
+                if missing:
+                    print(f'{case.name:<20} skipped, needs '
+                          f'{", ".join(missing)}')
+                    continue
+                result = time_case(case, ctx)
+                results[case.name] = result
+                print(f'{case.name:<20} {result["median"] * 1e3:12.3f} ms '
+                      f'(min {result["min"] * 1e3:.3f} ms)')
+        finally:
+            ctx.close()
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'meta': {
+                    'time': datetime.now(timezone.utc).isoformat(),
+                    'python': sys.version,
+                    'platform': platform.platform(),
+                },
+                'results': results,
+            }, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
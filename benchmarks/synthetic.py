@@ -0,0 +1,93 @@
+"""Synthetic documents for the benchmarks."""
+import importlib.util
+
+HEADER = '---\ntitle: Synthetic report\noutput:\n    {output}: {{}}\n---\n'
+
+PROSE = (
+    'Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod '
+    'tempor incididunt ut labore et dolore magna aliqua. The total was '
+    'noted, with `inline` markup that is not code.\n\n'
+)
+
+TABLE_ROW = '| {0} | {0:.3f} | label-{0} |\n'
+
+CHUNK = '\n```{{python chunk_{0}, echo=FALSE}}\n{1}\n```\n\n'
+
+INLINE = 'Value {0} is `python x_{0} + 1`.\n\n'
+
+FIGURE_SETUP_CODE = 'import matplotlib.pyplot as plt'
+
+FIGURE_CODE = '''\
+fig_{0} = plt.figure()
+plt.plot(range({0} + 10))
+display_fig(fig_{0}, slug='fig-{0}', caption='Figure {0}')
+plt.close(fig_{0})'''
+
+DATAFRAME_SETUP_CODE = 'import pandas as pd'
+
+DATAFRAME_CODE = '''\
+df_{0} = pd.DataFrame({{'a': range({1}), 'b': [i / 3 for i in range({1})]}})'''
+
+DISPLAY_DATAFRAME_CODE = 'display(df_{0})'
+
+TABLE_CODE = "display_table(df_{0}, slug='tbl-{0}', fmt='{1}')"
+
+
+def has_module(name):
+    return importlib.util.find_spec(name) is not None
+
+
+def _prose(n_bytes):
+    return (PROSE * (n_bytes // len(PROSE) + 1))[:n_bytes]
+
+
+def make_document(n_chunks=10, n_inline=10, prose_bytes=10000, n_figures=0,
+                  df_rows=0, table_fmt=None, output='md_document'):
+    """Return a document of `n_chunks` chunks, each setting a variable.
+
+    Inline expressions read those variables, and the prose is spread between
+    the chunks. The first `n_figures` chunks also make a figure, and with
+    `df_rows` the last one also shows a DataFrame of that many rows, through
+    `display_table` in the format `table_fmt` if that's given.
+    """
+    setup = []
+    if n_figures:
+        setup.append(FIGURE_SETUP_CODE)
+    if df_rows:
+        setup.append(DATAFRAME_SETUP_CODE)
+    sects = [HEADER.format(output=output)]
+    if setup:
+        sects.append(CHUNK.format('setup', '\n'.join(setup)))
+    n_sects = max(n_chunks, 1)
+    for i in range(n_chunks):
+        code = [f'x_{i} = {i} * 2']
+        if i < n_figures:
+            code.append(FIGURE_CODE.format(i))
+        if df_rows and i == n_chunks - 1:
+            code.append(DATAFRAME_CODE.format(i, df_rows))
+            if table_fmt is None:
+                code.append(DISPLAY_DATAFRAME_CODE.format(i))
+            else:
+                code.append(TABLE_CODE.format(i, table_fmt))
+        sects.append(_prose(prose_bytes // n_sects))
+        sects.append(CHUNK.format(i, '\n'.join(code)))
+        sects.extend(INLINE.format(i) for j in range(n_inline)
+                     if j % n_sects == i)
+    return ''.join(sects)
+
+
+def make_document_of_size(n_bytes):
+    """Return a document of about `n_bytes`, of prose, tables and chunks."""
+    sects = [HEADER.format(output='html_document')]
+    size = len(sects[0])
+    i = 0
+    while size < n_bytes:
+        sect = PROSE * 4
+        sect += INLINE.format(i)
+        sect += '| a | b | c |\n|---|---|---|\n'
+        sect += ''.join(TABLE_ROW.format(j) for j in range(i, i + 20))
+        sect += CHUNK.format(i, f'x_{i} = {i} * 2\nprint(x_{i})')
+        sects.append(sect)
+        size += len(sect)
+        i += 1
+    return ''.join(sects)
@@ -5,15 +5,96 @@
 
 from __future__ import print_function
 
+import base64
+import io
+
 import matplotlib
 from matplotlib.backends.backend_agg import new_figure_manager, FigureCanvasAgg # analysis: ignore
 from matplotlib._pylab_helpers import Gcf
+from matplotlib.collections import Collection
+from matplotlib.lines import Line2D
 
 from IPython.core.getipython import get_ipython
-from IPython.core.display import display
+from IPython.core.display import display, publish_display_data
 
 from ipykernel.pylab.config import InlineBackend
 
+from .preamble import PREAMBLE_VARS
+
+DEVICE_MIME_TYPES = {
+    'png': 'image/png',
+    'svg': 'image/svg+xml',
+    'jpeg': 'image/jpeg',
+    'webp': 'image/webp',
+}
+
+# Artists with at least this many points are rasterized in vector figures,
+# when asked.
+RASTERIZE_MIN_POINTS = 1000
+
+
+def _n_points(artist):
+    if isinstance(artist, Line2D):
+        return len(artist.get_xydata())
+    elif isinstance(artist, Collection):
+        # Such as the markers of a scatter plot, or the segments of a line
+        # collection.
+        return max(len(artist.get_offsets()),
+                   sum(len(path.vertices) for path in artist.get_paths()))
+    else:
+        return 0
+
+
+def _rasterize_dense_artists(fig, min_points=RASTERIZE_MIN_POINTS):
+    for ax in fig.axes:
+        for artist in ax.get_children():
+            if _n_points(artist) >= min_points:
+                artist.set_rasterized(True)
+
+
+def _quantize_png(data, compress_level):
+    # Matplotlib depends on Pillow, so it is available.
+    from PIL import Image
+    img = Image.open(io.BytesIO(data))
+    img = img.quantize(colors=256, method=Image.Quantize.FASTOCTREE)
+    out = io.BytesIO()
+    save_kwargs = {}
+    if compress_level is not None:
+        save_kwargs['compress_level'] = compress_level
+    img.save(out, format='png', **save_kwargs)
+    return out.getvalue()
+
+
+def publish_figure(fig):
+    """Publish a figure in the format, size and resolution that the current
+    chunk's options ask for."""
+    opts = PREAMBLE_VARS.get('figure_options') or {}
+    device = opts.get('device') or 'png'
+    width, height = opts.get('width'), opts.get('height')
+    if width is not None or height is not None:
+        fig.set_size_inches(width or fig.get_figwidth(),
+                            height or fig.get_figheight())
+    if device == 'svg' and opts.get('rasterize'):
+        _rasterize_dense_artists(fig)
+
+    savefig_kwargs = {'format': device, 'bbox_inches': 'tight'}
+    if opts.get('dpi') is not None:
+        savefig_kwargs['dpi'] = opts['dpi']
+    compress_level = opts.get('compress_level')
+    if device == 'png' and compress_level is not None:
+        savefig_kwargs['pil_kwargs'] = {'compress_level': compress_level}
+    buf = io.BytesIO()
+    fig.savefig(buf, **savefig_kwargs)
+    data = buf.getvalue()
+    if device == 'png' and opts.get('quantize'):
+        data = _quantize_png(data, compress_level)
+
+    if device == 'svg':
+        datum = data.decode()
+    else:
+        datum = base64.b64encode(data).decode()
+    publish_display_data({DEVICE_MIME_TYPES[device]: datum})
+
 
 def get_do_display(backend):
     return backend.shell.ast_node_interactivity != 'none'
@@ -42,7 +123,7 @@ def show(close=None, block=None):
     try:
         for figure_manager in Gcf.get_all_fig_managers():
             if do_display:
-                display(figure_manager.canvas.figure)
+                publish_figure(figure_manager.canvas.figure)
     finally:
         show._to_draw = []
         # only call close('all') if any to close
@@ -81,7 +162,7 @@ def draw_if_interactive():
 
     if not hasattr(fig, 'show'):
         # Queue up `fig` for display
-        fig.show = lambda *a: display(fig)
+        fig.show = lambda *a: publish_figure(fig)
 
     # If matplotlib was manually set to non-interactive mode, this function
     # should be a no-op (otherwise we'll generate duplicate plots, since a user
@@ -138,7 +219,7 @@ def flush_figures():
         for fig in [ fig for fig in show._to_draw if fig in active ]:
             try:
                 if do_display:
-                    display(fig)
+                    publish_figure(fig)
             except Exception as e:
                 # safely show traceback if in IPython, else raise
                 ip = get_ipython()
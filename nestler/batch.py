@@ -0,0 +1,119 @@
+"""Render many documents in parallel, each in its own process and kernel."""
+import glob
+import logging
+import os
+import os.path as opath
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.util import Finalize
+
+from . import kernel_pool
+from .output_routines import MARKDOWN_OUTPUT_FORMATS
+
+logger = logging.getLogger(__name__)
+
+INPUT_GLOB = '**/*.md'
+
+# The endings of our own markdown outputs, such as "report.out.md", which
+# the input glob also matches.
+OUTPUT_SUFFIXES = tuple(suffix
+                        for _, suffix in MARKDOWN_OUTPUT_FORMATS.values())
+
+RenderResult = namedtuple('RenderResult', ['in_path', 'duration', 'error'])
+
+# Each worker process keeps a kernel for all the documents it renders.
+_worker_kernel_pool = None
+
+
+def _is_own_output(path):
+    # Our own intermediate files, and outputs.
+    return (opath.dirname(path).endswith('_files')
+            or path.endswith(OUTPUT_SUFFIXES))
+
+
+def find_inputs(specs):
+    """Expand input paths, directories and glob patterns into file paths.
+
+    Directories and patterns leave out the files that rendering writes, so
+    that rendering them again doesn't render its own outputs.
+    """
+    in_paths = []
+    for spec in specs:
+        if opath.isdir(spec):
+            matches = sorted(
+                path
+                for path in glob.glob(opath.join(spec, INPUT_GLOB),
+                                      recursive=True)
+                if not _is_own_output(path)
+            )
+        elif glob.has_magic(spec):
+            matches = sorted(path
+                             for path in glob.glob(spec, recursive=True)
+                             if not _is_own_output(path))
+        else:
+            matches = [spec]
+        for path in matches:
+            if path not in in_paths:
+                in_paths.append(path)
+    return in_paths
+
+
+def render_file(in_path, **run_kwargs):
+    # Avoid a circular import.
+    from .nestler import run
+
+    out_path_base = opath.splitext(in_path)[0]
+    start = time.perf_counter()
+    try:
+        with open(in_path) as in_stream:
+            run(in_stream, out_path_base, **run_kwargs)
+    except Exception as e:
+        logger.exception(f'Failed to render "{in_path}"')
+        error = f'{type(e).__name__}: {e}'
+    else:
+        error = None
+    return RenderResult(in_path=in_path,
+                        duration=time.perf_counter() - start,
+                        error=error)
+
+
+def _init_worker(log_level):
+    global _worker_kernel_pool
+    logging.basicConfig(level=log_level)
+    _worker_kernel_pool = kernel_pool.KernelPool(1)
+    # Worker processes don't run atexit handlers, but they do run these.
+    Finalize(_worker_kernel_pool, _worker_kernel_pool.shutdown,
+             exitpriority=10)
+
+
+def _render_in_worker(in_path, run_kwargs):
+    return render_file(in_path, kernel_pool=_worker_kernel_pool,
+                       **run_kwargs)
+
+
+def render_files(in_paths, jobs=None, **run_kwargs):
+    """Render documents across `jobs` processes, and return a `RenderResult`
+    for each, in order."""
+    if jobs is None:
+        jobs = os.cpu_count()
+    jobs = min(jobs, len(in_paths))
+    log_level = logging.getLogger().getEffectiveLevel()
+    with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker,
+                             initargs=(log_level,)) as executor:
+        futures = [executor.submit(_render_in_worker, in_path, run_kwargs)
+                   for in_path in in_paths]
+        return [future.result() for future in futures]
+
+
+def print_summary(results):
+    for result in results:
+        status = 'ok' if result.error is None else 'FAILED'
+        line = f'{result.duration:8.2f} s  {status:<6}  {result.in_path}'
+        if result.error is not None:
+            line += f': {result.error}'
+        print(line)
+    n_failed = sum(result.error is not None for result in results)
+    total = sum(result.duration for result in results)
+    print(f'{len(results)} documents, {n_failed} failed, '
+          f'{total:.2f} s of rendering')
@@ -0,0 +1,345 @@
+"""On-disk cache of chunk results, for the `cache` chunk option.
+
+Entries are addressed by a hash of the chunk's code, its options and the keys
+of the chunks it depends on. Each entry holds the interpreted outputs of the
+chunk, and a snapshot of the variables it set, written by the kernel.
+
+The kernel-side functions at the bottom are called in the kernel, so this
+module keeps its imports light.
+"""
+import gzip
+import hashlib
+import json
+import logging
+import os
+import pickle
+import tempfile
+import types
+import warnings
+
+from . import depgraph
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_BYTES = 2 ** 30
+
+OUTS_EXT = 'outs'
+NAMESPACE_EXT = 'ns'
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+
+def _open_read(path):
+    # Read compressed or uncompressed files, so that changing the compression
+    # setting doesn't invalidate an existing cache.
+    with open(path, 'rb') as f:
+        magic = f.read(len(GZIP_MAGIC))
+    if magic == GZIP_MAGIC:
+        return gzip.open(path, 'rb')
+    else:
+        return open(path, 'rb')
+
+
+def _write_atomic(path, data, compress, mode=None):
+    if compress:
+        data = gzip.compress(data)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        # Temporary files are only readable by their owner.
+        if mode is not None:
+            os.chmod(tmp_path, mode)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def _hash(s):
+    return hashlib.sha256(s.encode()).hexdigest()
+
+
+def _options_str(options):
+    return '\0'.join(
+        f'{opt.value}={value!r}'
+        for opt, value in sorted(options.items(), key=lambda kv: kv[0].value)
+    )
+
+
+def chunk_key(code, options, upstream_keys):
+    return _hash('\0'.join([code, _options_str(options), *upstream_keys]))
+
+
+def manifest_path(cache_path, doc_path):
+    doc_id = _hash(os.path.abspath(doc_path))[:16]
+    return os.path.join(cache_path, f'manifest-{doc_id}.json')
+
+
+class ChunkStore:
+    """A directory of cache entries, evicting the least recently used."""
+
+    def __init__(self, path, max_bytes=DEFAULT_MAX_BYTES, compress=False):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.compress = compress
+        os.makedirs(self.path, exist_ok=True)
+
+    def _entry_path(self, key, ext):
+        return os.path.abspath(os.path.join(self.path, f'{key}.{ext}'))
+
+    def namespace_path(self, key):
+        return self._entry_path(key, NAMESPACE_EXT)
+
+    def get(self, key):
+        outs_path = self._entry_path(key, OUTS_EXT)
+        ns_path = self.namespace_path(key)
+        try:
+            with _open_read(outs_path) as f:
+                outs = pickle.load(f)
+            # Mark the entry as recently used.
+            os.utime(outs_path)
+            os.utime(ns_path)
+        except FileNotFoundError:
+            return None
+        return outs
+
+    def put(self, key, outs):
+        outs_path = self._entry_path(key, OUTS_EXT)
+        _write_atomic(outs_path, pickle.dumps(outs, pickle.HIGHEST_PROTOCOL),
+                      self.compress)
+        self.evict()
+
+    def _entries(self):
+        entries = {}
+        for entry in os.scandir(self.path):
+            key, _, ext = entry.name.partition('.')
+            if ext not in (OUTS_EXT, NAMESPACE_EXT):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                # Evicted by another process sharing the store.
+                continue
+            size, mtime = entries.get(key, (0, 0))
+            entries[key] = (size + stat.st_size, max(mtime, stat.st_mtime))
+        return entries
+
+    def evict(self):
+        entries = self._entries()
+        total = sum(size for size, _ in entries.values())
+        by_age = sorted(entries, key=lambda key: entries[key][1])
+        for key in by_age:
+            if total <= self.max_bytes:
+                break
+            logger.info(f'Evicting cache entry "{key}"')
+            for ext in (OUTS_EXT, NAMESPACE_EXT):
+                try:
+                    os.remove(self._entry_path(key, ext))
+                except FileNotFoundError:
+                    pass
+            total -= entries[key][0]
+
+
+class DocumentCache:
+    """The stores, keys and dependencies of the chunks of one document."""
+
+    def __init__(self, chunks, max_bytes=DEFAULT_MAX_BYTES, compress=False,
+                 manifest_path=None):
+        self.max_bytes = max_bytes
+        self.compress = compress
+        self.manifest_path = manifest_path
+        self.nodes = depgraph.build_graph(chunks)
+        self.keys = []
+        self.fingerprints = []
+        for node, (code, options) in zip(self.nodes, chunks):
+            key = chunk_key(code, options,
+                            [self.keys[i] for i in node.upstream])
+            self.keys.append(key)
+            self.fingerprints.append({
+                'key': key,
+                'code': _hash(code),
+                'options': _hash(_options_str(options)),
+            })
+        # How each chunk was evaluated: 'reused', 'run' or 'uncached'.
+        self.runs = {}
+        self._stores = {}
+        self._previous_manifest = self._load_manifest()
+
+    def store(self, path):
+        if path not in self._stores:
+            self._stores[path] = ChunkStore(path, max_bytes=self.max_bytes,
+                                            compress=self.compress)
+        return self._stores[path]
+
+    def _load_manifest(self):
+        if self.manifest_path is None:
+            return {}
+        try:
+            with open(self.manifest_path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def save_manifest(self):
+        # Only keep a manifest for documents that use the cache.
+        if self.manifest_path is None or not self._stores:
+            return
+        manifest = {node.name: fingerprint
+                    for node, fingerprint in zip(self.nodes,
+                                                 self.fingerprints)}
+        os.makedirs(os.path.dirname(self.manifest_path) or '.', exist_ok=True)
+        _write_atomic(self.manifest_path, json.dumps(manifest).encode(),
+                      compress=False)
+
+    def _rerun_reason(self, node):
+        previous = self._previous_manifest.get(node.name)
+        fingerprint = self.fingerprints[node.index]
+        if previous is None:
+            return 'not run before'
+        elif previous['code'] != fingerprint['code']:
+            return 'code changed'
+        elif previous['options'] != fingerprint['options']:
+            return 'options changed'
+        changed = [
+            self.nodes[i].name for i in node.upstream
+            if (self._previous_manifest.get(self.nodes[i].name, {})
+                .get('key') != self.keys[i])
+        ]
+        if changed:
+            return f'upstream changed: {", ".join(changed)}'
+        return 'no stored result'
+
+    def explain(self):
+        """Yield the name of each chunk, whether it was run, and why."""
+        for node in self.nodes:
+            run = self.runs.get(node.index)
+            if run is None:
+                yield node.name, False, 'not evaluated'
+            elif run == 'reused':
+                yield node.name, False, 'unchanged'
+            elif run == 'uncached':
+                yield node.name, True, 'caching disabled'
+            else:
+                yield node.name, True, self._rerun_reason(node)
+
+
+# Kernel side.
+
+_snapshot_ids = {}
+_snapshot_registered_counts = {}
+
+
+def _user_namespace():
+    from IPython import get_ipython
+    ip = get_ipython()
+    return {
+        name: value for name, value in ip.user_ns.items()
+        if not name.startswith('_') and name not in ip.user_ns_hidden
+    }
+
+
+def _serializer():
+    try:
+        import dill
+    except ImportError:
+        return pickle
+    else:
+        return dill
+
+
+def _dump_value(serializer, value):
+    # Modules are restored by importing them again.
+    if isinstance(value, types.ModuleType):
+        return ('module', value.__name__)
+    # Plain pickle stores these by reference to the namespace, which won't
+    # hold them when the snapshot is restored.
+    if (serializer is pickle
+            and isinstance(value, (types.FunctionType, type))
+            and value.__module__ == '__main__'):
+        raise pickle.PicklingError('needs dill to be pickled by value')
+    return ('value', serializer.dumps(value))
+
+
+def _load_value(serializer, dumped):
+    kind, data = dumped
+    if kind == 'module':
+        import importlib
+        return importlib.import_module(data)
+    else:
+        return serializer.loads(data)
+
+
+def _preamble_registers():
+    # The figures and tables registered by the chunk, which later references
+    # to them need.
+    from .preamble import PREAMBLE_VARS
+    return {name: PREAMBLE_VARS[name]
+            for name in ('registered_figures', 'registered_tables')}
+
+
+def snapshot_begin():
+    global _snapshot_ids, _snapshot_registered_counts
+    _snapshot_ids = {name: id(value)
+                     for name, value in _user_namespace().items()}
+    _snapshot_registered_counts = {
+        name: len(register)
+        for name, register in _preamble_registers().items()
+    }
+
+
+def _write_snapshot(path, compress, ids, registered_counts, written=()):
+    # Save the variables that aren't the objects in `ids`, or that are in
+    # `written`, and the registrations after the counts in
+    # `registered_counts`.
+    serializer = _serializer()
+    snapshot = {}
+    for name, value in _user_namespace().items():
+        if ids.get(name) == id(value) and name not in written:
+            continue
+        try:
+            snapshot[name] = _dump_value(serializer, value)
+        except Exception as e:
+            warnings.warn(f'Not saving variable "{name}": {e}')
+    registered = {
+        name: register[registered_counts.get(name, 0):]
+        for name, register in _preamble_registers().items()
+    }
+    data = pickle.dumps((serializer.__name__, snapshot, registered),
+                        pickle.HIGHEST_PROTOCOL)
+    _write_atomic(path, data, compress)
+
+
+def snapshot_end(path, compress=False, written=None):
+    # `written` are the names the chunk assigns, as `depgraph` finds them,
+    # which include objects changed in place rather than bound anew. Without
+    # them, save the whole namespace.
+    if written is None:
+        ids = {}
+    else:
+        ids = _snapshot_ids
+    _write_snapshot(path, compress, ids, _snapshot_registered_counts,
+                    written=set(written or ()))
+
+
+def checkpoint(path, compress=False):
+    # Save the whole namespace, for `restore` to load into a fresh kernel.
+    _write_snapshot(path, compress, {}, {})
+
+
+def restore(path):
+    with _open_read(path) as f:
+        serializer_name, snapshot, registered = pickle.load(f)
+    if serializer_name == 'dill':
+        import dill as serializer
+    else:
+        serializer = pickle
+    from IPython import get_ipython
+    user_ns = get_ipython().user_ns
+    for name, dumped in snapshot.items():
+        try:
+            user_ns[name] = _load_value(serializer, dumped)
+        except Exception as e:
+            warnings.warn(f'Could not restore variable "{name}": {e}')
+    for name, register in _preamble_registers().items():
+        register.extend(registered[name])
@@ -46,3 +46,41 @@ def set_interactivity(client, value, comm_id=INTERACTIVITY_COMM_ID):
         comm_id=comm_id,
         data={'value': value},
     )
+
+
+FIGURE_OPTIONS_TARGET_NAME = 'figure_options'
+FIGURE_OPTIONS_COMM_ID = 'figure_options'
+
+
+def figure_options_comm_open(comm, open_msg,
+                             comm_id=FIGURE_OPTIONS_COMM_ID):
+    # Set the options the figure backend uses for the figures that follow.
+    def msg_callback(msg):
+        from .preamble import PREAMBLE_VARS
+        data = msg['content']['data']
+        PREAMBLE_VARS['figure_options'] = data['options']
+    comms.configure_comm(comm, comm_id=comm_id,
+                         msg_callback=msg_callback)
+
+
+def open_figure_options_comm(client, new_comm_comm_id=NEW_COMM_COMM_ID,
+                             target_name=FIGURE_OPTIONS_TARGET_NAME,
+                             comm_id=FIGURE_OPTIONS_COMM_ID):
+    client.comm_message(
+        comm_id=new_comm_comm_id,
+        data={
+            'new_target_name': target_name,
+            'comm_open_callback': 'nestler.comms.figure_options_comm_open',
+        }
+    )
+    client.comm_open(
+        comm_id=comm_id,
+        target_name=target_name,
+    )
+
+
+def set_figure_options(client, options, comm_id=FIGURE_OPTIONS_COMM_ID):
+    client.comm_message(
+        comm_id=comm_id,
+        data={'options': options},
+    )
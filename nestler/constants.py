@@ -52,3 +52,46 @@ class ChunkOption(Enum):
     # Figure dimensions, in inches.
     figure_height = 'fig.height'
     figure_width = 'fig.width'
+    # Format of figures: 'png', 'svg', 'jpeg' or 'webp'.
+    figure_device = 'dev'
+    # Resolution of raster figures, in dots per inch.
+    figure_dpi = 'dpi'
+    # Whether to rasterize artists with many points in vector figures.
+    figure_rasterize = 'fig.rasterize'
+    # Whether to reduce PNG figures to a palette of at most 256 colors.
+    figure_quantize = 'fig.quantize'
+    # zlib compression level of PNG figures, from 0 to 9.
+    figure_compress_level = 'fig.compress'
+    # The most lines and bytes of text output to show. The rest is saved to a
+    # file in the output path, and linked to.
+    max_output_lines = 'max_output_lines'
+    max_output_bytes = 'max_output_bytes'
+    # Directory in which to save output beyond the limits.
+    output_path = 'output.path'
+    # Whether to save the namespace to the journal after the chunk, rather
+    # than every so many chunks.
+    checkpoint = 'checkpoint'
+    # The most rows and columns of tables that `display_table` shows. Rows
+    # and columns in the middle are left out beyond these.
+    table_max_rows = 'tbl.max_rows'
+    table_max_cols = 'tbl.max_cols'
+    # How `display_table` renders tables.
+    table_format = 'tbl.format'
+
+
+class TableFormat(Enum):
+    # Styled tables through pandas' Styler, and plain HTML for the rest.
+    auto = 'auto'
+    # Through pandas' Styler, which renders each cell through a template.
+    styled = 'styled'
+    # Plain HTML, much faster for large tables.
+    plain = 'plain'
+    # Pages of rows, drawn in the browser from the data as JSON.
+    paged = 'paged'
+
+
+class FigureDevice(Enum):
+    png = 'png'
+    svg = 'svg'
+    jpeg = 'jpeg'
+    webp = 'webp'
@@ -0,0 +1,102 @@
+"""Dependencies between code chunks.
+
+A chunk depends on the chunks named in its `dependson` option, and on the
+latest earlier chunk to assign each name that it reads.
+"""
+import ast
+from collections import namedtuple
+
+from .constants import ChunkOption
+
+ChunkNode = namedtuple('ChunkNode', ['index', 'name', 'upstream'])
+
+
+def _root_name(node):
+    while isinstance(node, (ast.Attribute, ast.Subscript)):
+        node = node.value
+    if isinstance(node, ast.Name):
+        return node.id
+    return None
+
+
+def _is_method_call(node):
+    return isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute)
+
+
+def names_used(code):
+    """Return the names a piece of code reads, and those it assigns.
+
+    Names assigned inside functions are counted as assigned by the code, and
+    assigning to an attribute or item of a name counts as assigning the name,
+    so that any error leans toward finding more dependencies. So does calling
+    a method of a name for its effect, as in `lst.append(x)` or
+    `df.drop(..., inplace=True)`, since the method may change the object.
+    """
+    tree = ast.parse(code)
+    reads, writes = set(), set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name):
+            if isinstance(node.ctx, ast.Load):
+                reads.add(node.id)
+            else:
+                writes.add(node.id)
+        elif isinstance(node, (ast.Attribute, ast.Subscript)):
+            if not isinstance(node.ctx, ast.Load):
+                root_name = _root_name(node)
+                if root_name is not None:
+                    writes.add(root_name)
+        elif isinstance(node, ast.Expr) and _is_method_call(node.value):
+            # The result is thrown away, so the call is for its effect.
+            root_name = _root_name(node.value.func)
+            if root_name is not None:
+                writes.add(root_name)
+        elif _is_method_call(node) and any(
+                keyword.arg == 'inplace' for keyword in node.keywords):
+            root_name = _root_name(node.func)
+            if root_name is not None:
+                writes.add(root_name)
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef,
+                               ast.ClassDef)):
+            writes.add(node.name)
+        elif isinstance(node, (ast.Import, ast.ImportFrom)):
+            for alias in node.names:
+                writes.add(alias.asname or alias.name.split('.')[0])
+    return reads, writes
+
+
+def chunk_name(index, options):
+    label = options[ChunkOption.label]
+    return label if label is not None else f'chunk {index + 1}'
+
+
+def build_graph(chunks):
+    """Return a `ChunkNode` for each (code, options) pair in `chunks`."""
+    nodes = []
+    label_to_index = {}
+    last_writers = {}
+    for index, (code, options) in enumerate(chunks):
+        upstream = set()
+        for dep in options[ChunkOption.chunk_dependencies] or ():
+            if isinstance(dep, int):
+                dep_index = dep - 1
+            else:
+                dep_index = label_to_index.get(dep)
+            if dep_index is None or not 0 <= dep_index < index:
+                raise ValueError(f'Chunk {index + 1} depends on "{dep}", '
+                                 f'which is not an earlier chunk')
+            upstream.add(dep_index)
+        try:
+            reads, writes = names_used(code)
+        except SyntaxError:
+            # Can't tell what it uses, so assume everything.
+            upstream.update(range(index))
+        else:
+            upstream.update(last_writers[name] for name in reads
+                            if name in last_writers)
+            for name in writes:
+                last_writers[name] = index
+        name = chunk_name(index, options)
+        label_to_index[name] = index
+        nodes.append(ChunkNode(index=index, name=name,
+                               upstream=tuple(sorted(upstream))))
+    return nodes
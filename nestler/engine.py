@@ -0,0 +1,249 @@
+"""Asynchronous execution of code on kernels.
+
+One event loop can drive any number of kernels, such as to evaluate several
+documents in one process with `asyncio.gather`, or from an async web service.
+Each kernel should be used by one coroutine at a time. The blocking
+functions in `execute` run these coroutines on a shared event loop in a
+background thread.
+"""
+import asyncio
+import logging
+
+from . import messages
+
+logger = logging.getLogger(__name__)
+
+# The IPython extension that sets up the kernel for documents.
+PREAMBLE_EXTENSION = 'nestler.preamble'
+
+
+def submit_code(client, code, implicit_display, stop_on_error=True,
+                figure_options=None):
+    # The kernel libraries are imported when a client is first made, rather
+    # than with this module.
+    from . import comms
+
+    interactivity = 'last_expr' if implicit_display else 'none'
+    # The kernel handles shell messages in order, so this applies to the
+    # request that follows, even if others are still queued.
+    comms.set_interactivity(client, interactivity)
+    if figure_options is not None:
+        comms.set_figure_options(client, figure_options)
+    return client.execute(code, stop_on_error=stop_on_error)
+
+
+class ReplyRouter:
+    """Sort the kernel's messages by the request they answer.
+
+    Several requests may be queued on the kernel at once. Messages for
+    requests that aren't being waited on are kept until they are. Only one
+    request may be waited on at a time.
+    """
+
+    def __init__(self, client, timeout=None):
+        import zmq
+
+        self.client = client
+        self.timeout = timeout
+        self._replies = {}
+        self._limiters = {}
+        self._finished = set()
+        self._shell_replies = {}
+        # Plain sockets on the client's connections, read from whenever the
+        # event loop finds either of them readable.
+        self._shell_socket = zmq.Socket.shadow(
+            client.shell_channel.socket.underlying)
+        self._iopub_socket = zmq.Socket.shadow(
+            client.iopub_channel.socket.underlying)
+        self._waiting = None
+
+    def submit(self, code, implicit_display, stop_on_error=True,
+               figure_options=None, limiter=None):
+        msg_id = submit_code(self.client, code, implicit_display,
+                             stop_on_error=stop_on_error,
+                             figure_options=figure_options)
+        self._replies[msg_id] = []
+        if limiter is not None:
+            self._limiters[msg_id] = limiter
+        return msg_id
+
+    def submit_expressions(self, expressions):
+        # The kernel evaluates user expressions after running the code, and
+        # sends their results in its reply, so run no code.
+        msg_id = self.client.execute('', silent=True, store_history=False,
+                                     user_expressions=expressions)
+        self._replies[msg_id] = []
+        return msg_id
+
+    def _add_shell_msg(self, msg):
+        parent_id = msg['parent_header'].get('msg_id')
+        if parent_id in self._replies:
+            self._shell_replies[parent_id] = msg
+        else:
+            logger.debug(f"Ignoring shell {msg['msg_type']} "
+                         f"for another request")
+
+    def _add_iopub_msg(self, reply):
+        parent_id = reply['parent_header'].get('msg_id')
+        if parent_id not in self._replies:
+            # Such as the status messages prompted by comm messages.
+            logger.debug(f"Ignoring iopub {reply['msg_type']} "
+                         f"for another request")
+        elif messages.add_reply(self._replies[parent_id], reply,
+                                self._limiters.get(parent_id)):
+            self._finished.add(parent_id)
+
+    def _drain(self, socket, add_msg):
+        # Take in every message that is waiting, without a round of the
+        # event loop for each.
+        import zmq
+
+        session = self.client.session
+        while True:
+            try:
+                msg = socket.recv_multipart(zmq.NOBLOCK)
+            except zmq.Again:
+                return
+            _, msg = session.feed_identities(msg)
+            add_msg(session.deserialize(msg))
+
+    def _is_done(self, msg_id):
+        return msg_id in self._finished and msg_id in self._shell_replies
+
+    def _on_readable(self):
+        self._drain(self._shell_socket, self._add_shell_msg)
+        self._drain(self._iopub_socket, self._add_iopub_msg)
+        msg_id, done = self._waiting
+        if self._is_done(msg_id) and not done.done():
+            done.set_result(None)
+
+    async def _receive(self, msg_id):
+        # Take in messages from both channels as they come, until the kernel
+        # has finished the request and sent its reply. The kernel tells us
+        # when it is done by going idle with the request as the parent, and
+        # the shell reply must be consumed even if it isn't used, so that it
+        # isn't mistaken for another request's.
+        loop = asyncio.get_running_loop()
+        self._waiting = (msg_id, loop.create_future())
+        fds = [socket.FD for socket in (self._shell_socket,
+                                        self._iopub_socket)]
+        for fd in fds:
+            loop.add_reader(fd, self._on_readable)
+        try:
+            # The sockets only signal new messages, so take in any that came
+            # before we started watching.
+            self._on_readable()
+            # Wait as long as the code takes to run.
+            await asyncio.wait_for(self._waiting[1], self.timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError(f'Request not finished within '
+                               f'{self.timeout:.1f} s')
+        finally:
+            for fd in fds:
+                loop.remove_reader(fd)
+            self._waiting = None
+
+    async def wait(self, msg_id):
+        """Return the iopub replies to a request, once it has finished."""
+        replies, _ = await self.wait_with_reply(msg_id)
+        return replies
+
+    async def wait_with_reply(self, msg_id):
+        """Return the iopub replies to a request, once it has finished, and
+        the shell reply."""
+        await self._receive(msg_id)
+        shell_reply = self._shell_replies.pop(msg_id)
+        self._finished.remove(msg_id)
+        replies = self._replies.pop(msg_id)
+        limiter = self._limiters.pop(msg_id, None)
+        if limiter is not None:
+            truncated = limiter.close()
+            if truncated is not None:
+                replies.append(truncated)
+        return replies, shell_reply
+
+
+async def exec_code_to_replies(client, code, implicit_display, timeout=None,
+                               figure_options=None, limiter=None):
+    router = ReplyRouter(client, timeout=timeout)
+    msg_id = router.submit(code, implicit_display,
+                           figure_options=figure_options, limiter=limiter)
+    return await router.wait(msg_id)
+
+
+async def exec_code(client, code, implicit_display, figure_options=None,
+                    limiter=None, timeout=None):
+    replies = await exec_code_to_replies(client, code, implicit_display,
+                                         timeout=timeout,
+                                         figure_options=figure_options,
+                                         limiter=limiter)
+    return messages.interpret_replies(replies)
+
+
+async def eval_expressions(client, expressions, timeout=None):
+    """Return the outputs of each of `expressions`, evaluated in one request.
+
+    The outputs are as `exec_code` gives with implicit display. Each
+    expression that fails gets its own error.
+    """
+    router = ReplyRouter(client, timeout=timeout)
+    msg_id = router.submit_expressions(
+        {str(i): expression for i, expression in enumerate(expressions)}
+    )
+    _, shell_reply = await router.wait_with_reply(msg_id)
+    content = shell_reply['content']
+    if content['status'] != 'ok':
+        # Such as when the kernel aborts the request after an earlier error.
+        raise RuntimeError(f"Expressions not evaluated: '{content['status']}'")
+    results = content['user_expressions']
+    return [messages.expression_outs(results[str(i)])
+            for i in range(len(expressions))]
+
+
+async def exec_kernel_function(client, module_name, func_name, *args,
+                               implicit_display=False, timeout=None):
+    # Call without binding any names in the user's namespace.
+    args_str = ', '.join(repr(arg) for arg in args)
+    code = (f'__import__({module_name!r}, fromlist=["_"])'
+            f'.{func_name}({args_str})')
+    return await exec_code(client, code, implicit_display=implicit_display,
+                           timeout=timeout)
+
+
+async def get_kernel_client(connection_file=None):
+    from jupyter_client import AsyncKernelManager, AsyncKernelClient
+    from . import comms
+
+    if connection_file is None:
+        manager = AsyncKernelManager()
+        await manager.start_kernel(
+            extra_arguments=[f'--ext={PREAMBLE_EXTENSION}'],
+        )
+        client = manager.client()
+    else:
+        client = AsyncKernelClient(connection_file=connection_file)
+        client.load_connection_file()
+    client.start_channels()
+
+    # Open the new-comm comm handler.
+    comms.open_register_target_comm(client)
+    comms.open_interactivity_comm(client)
+    comms.open_figure_options_comm(client)
+
+    return client
+
+
+async def load_preamble(client):
+    # Kernels that we start load the preamble as they boot, so this only
+    # loads it into kernels started some other way.
+    await exec_code(
+        client,
+        f'get_ipython().extension_manager.load_extension('
+        f'{PREAMBLE_EXTENSION!r})',
+        implicit_display=False,
+    )
+
+
+async def shutdown(client):
+    client.shutdown()
+    client.stop_channels()
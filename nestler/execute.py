@@ -1,146 +1,140 @@
-from queue import Empty
-import logging
-from collections import namedtuple
+"""Blocking execution of code on kernels.
 
-from jupyter_client import KernelManager, BlockingKernelClient
+These wrap the coroutines of `engine`, which run on a shared event loop in a
+background thread, so they may be called from any thread except that one.
+"""
+import asyncio
+import logging
+import threading
+import time
+from contextlib import contextmanager
 
-from . import comms
+from . import engine
+from . import trace
+from .messages import interpret_replies
 
 logger = logging.getLogger(__name__)
 
-TIMEOUT_SECONDS = 2
-
-
-def exec_code_to_replies(client, code, implicit_display):
-    interactivity = 'last_expr' if implicit_display else 'none'
-    comms.set_interactivity(client, interactivity)
-
-    client.execute(code)
-    replies = []
-    while True:
-        try:
-            reply = client.get_iopub_msg(timeout=TIMEOUT_SECONDS)
-        except Empty:
-            logger.info('All messages received')
-            break
-        c = reply['content']
-        msg_type = reply['msg_type']
-        if msg_type == 'stream':
-            logger.debug(f"Got {msg_type} reply: '{c}'")
-            replies.append(reply)
-        elif msg_type == 'execute_input':
-            logger.debug(f"Executing:\n```\n{c['code']}\n```")
-        elif msg_type in ('execute_result', 'display_data'):
-            logger.debug(f"Got {msg_type} reply: '{c}'")
-            replies.append(reply)
-        elif msg_type == 'status':
-            status = c['execution_state']
-            logger.info(f"Kernel is '{status}'")
-            if status == 'idle':
-                if replies:
-                    break
-        elif msg_type == 'error':
-            replies.append(reply)
-        else:
-            raise NotImplementedError(reply)
-    return replies
-
-
-ExecOutput = namedtuple('ExecOutput', 'kind content')
-
-
-def interpret_replies(replies):
-    outs = {}
-    for reply in replies:
-        msg_type = reply['msg_type']
-        if reply['metadata']:
-            import pdb; pdb.set_trace()
-        if msg_type in ('execute_result', 'display_data'):
-            data = reply[u'content'][u'data']
-            for datum_type, datum in data.items():
-                if datum_type == 'text/plain':
-                    if msg_type == 'display_data':
-                        kind = 'display_text'
-                    else:
-                        kind = 'text'
-                    outs.setdefault(kind, []).append(
-                        datum.strip("'")
-                    )
-                elif datum_type == 'text/html':
-                    outs.setdefault('html', []).append(
-                        datum
-                    )
-                elif datum_type == 'image/png':
-                    outs.setdefault('image', []).append(
-                        {
-                            'format': datum_type,
-                            'data': datum,
-                            'slug': None,
-                            'caption': None,
-                        },
-                    )
-                elif datum_type == 'application/javascript':
-                    outs.setdefault('script', []).append(
-                        datum,
-                    )
-                elif datum_type == 'application/vnd.bokehjs_load.v0+json':
-                    outs.setdefault('script', []).append(
-                        datum,
-                    )
-                elif datum_type == 'application/json':
-                    if datum.get('kind') == 'caption':
-                        outs.setdefault('caption', []).append(
-                            datum
-                        )
-                    else:
-                        raise NotImplementedError(datum)
-                else:
-                    raise NotImplementedError(datum_type)
-        elif msg_type == 'stream':
-            txt = reply['content']['text'].rstrip()
-            stream_name = reply['content']['name']
-            outs.setdefault(stream_name, []).append(
-                txt,
-            )
-        elif msg_type == 'error':
-            c = reply['content']
-            outs.setdefault('error', []).append(
-                {
-                    'name': c['ename'],
-                    'value': c['evalue'],
-                },
-            )
-        else:
-            raise NotImplementedError(msg_type)
-    for out, cap in zip(outs.get('image', []), outs.get('caption', [])):
-        out['slug'] = cap['slug']
-        out['caption'] = cap['caption']
-    outs.pop('caption', None)
-    return outs
+_loop = None
+_loop_lock = threading.Lock()
+# Per thread, the time by which requests to kernels must finish.
+_local = threading.local()
+
+
+def _get_loop():
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name='nestler-engine',
+                             daemon=True).start()
+    return _loop
+
+
+def run_sync(coro):
+    """Run a coroutine on the engine's event loop, and return its result."""
+    return asyncio.run_coroutine_threadsafe(coro, _get_loop()).result()
+
+
+async def _call(func, *args, **kwargs):
+    # Messages are sent on the event loop's thread, as its sockets aren't
+    # safe to use from others.
+    return func(*args, **kwargs)
+
+
+@contextmanager
+def time_limit(seconds):
+    """Make requests to kernels from this thread raise `TimeoutError` once
+    `seconds` have passed.
+
+    The kernel may still be running the request, so shouldn't be reused.
+    """
+    _local.deadline = time.monotonic() + seconds
+    try:
+        yield
+    finally:
+        _local.deadline = None
+
+
+def _timeout(timeout):
+    deadline = getattr(_local, 'deadline', None)
+    if deadline is None:
+        return timeout
+    remaining = max(deadline - time.monotonic(), 0)
+    return remaining if timeout is None else min(timeout, remaining)
+
+
+class ReplyRouter:
+    """A blocking `engine.ReplyRouter`."""
 
+    def __init__(self, client, timeout=None):
+        self._router = engine.ReplyRouter(client, timeout=_timeout(timeout))
 
-def exec_code(client, code, implicit_display):
-    replies = exec_code_to_replies(client, code, implicit_display)
-    outs = interpret_replies(replies)
+    def submit(self, code, implicit_display, stop_on_error=True,
+               figure_options=None, limiter=None):
+        return run_sync(_call(self._router.submit, code, implicit_display,
+                              stop_on_error=stop_on_error,
+                              figure_options=figure_options,
+                              limiter=limiter))
+
+    def submit_expressions(self, expressions):
+        return run_sync(_call(self._router.submit_expressions, expressions))
+
+    def wait(self, msg_id):
+        """Return the iopub replies to a request, once it has finished."""
+        return run_sync(self._router.wait(msg_id))
+
+    def wait_with_reply(self, msg_id):
+        """Return the iopub replies to a request, once it has finished, and
+        the shell reply."""
+        return run_sync(self._router.wait_with_reply(msg_id))
+
+
+def exec_code_to_replies(client, code, implicit_display, timeout=None,
+                         figure_options=None, limiter=None):
+    return run_sync(engine.exec_code_to_replies(
+        client, code, implicit_display, timeout=_timeout(timeout),
+        figure_options=figure_options, limiter=limiter,
+    ))
+
+
+def exec_code(client, code, implicit_display, figure_options=None,
+              limiter=None):
+    with trace.span('execute', 'kernel'):
+        replies = exec_code_to_replies(client, code, implicit_display,
+                                       figure_options=figure_options,
+                                       limiter=limiter)
+    with trace.span('interpret replies', 'messages'):
+        outs = interpret_replies(replies)
     return outs
 
-def recover_exception(out):
-    sexc = f"{out['name']}: {out['value']}"
-    return sexc
+
+def eval_expressions(client, expressions, timeout=None):
+    """Return the outputs of each of `expressions`, evaluated in one request.
+
+    The outputs are as `exec_code` gives with implicit display. Each
+    expression that fails gets its own error.
+    """
+    with trace.span('evaluate expressions', 'kernel', n=len(expressions)):
+        return run_sync(engine.eval_expressions(client, expressions,
+                                                timeout=_timeout(timeout)))
+
+
+def exec_kernel_function(client, module_name, func_name, *args,
+                         implicit_display=False):
+    return run_sync(engine.exec_kernel_function(
+        client, module_name, func_name, *args,
+        implicit_display=implicit_display, timeout=_timeout(None),
+    ))
 
 
 def get_kernel_client(connection_file=None):
-    if connection_file is None:
-        manager = KernelManager()
-        manager.start_kernel()
-        client = manager.client()
-    else:
-        client = BlockingKernelClient(connection_file=connection_file)
-        client.load_connection_file()
-    client.start_channels()
-
-    # Open the new-comm comm handler.
-    comms.open_register_target_comm(client)
-    comms.open_interactivity_comm(client)
-
-    return client
+    return run_sync(engine.get_kernel_client(connection_file=connection_file))
+
+
+def load_preamble(client):
+    run_sync(engine.load_preamble(client))
+
+
+def shutdown(client):
+    run_sync(engine.shutdown(client))
@@ -0,0 +1,65 @@
+"""Figure files named by the hash of their contents, for the `fig_store`
+option.
+
+Identical figures, from any chunk or document that shares a store, are kept
+in a single file, and a file that already exists is never written again.
+"""
+import base64
+import hashlib
+import mimetypes
+import os
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+
+from .cache import _write_atomic
+
+# The number of payloads whose files each store remembers, to skip decoding
+# and hashing them when a document is rendered to several formats.
+MEMO_SIZE = 1024
+
+# Figures are served along with their documents.
+FILE_MODE = 0o644
+
+
+class FigureStore:
+
+    def __init__(self, path, memo_size=MEMO_SIZE):
+        self.path = os.path.abspath(path)
+        self.memo_size = memo_size
+        self._memo = OrderedDict()
+        self._lock = threading.Lock()
+        os.makedirs(self.path, exist_ok=True)
+
+    def put(self, fmt, data):
+        """Store a base64-encoded figure of MIME type `fmt`, and return the
+        path of its file."""
+        memo_key = (fmt, data)
+        with self._lock:
+            fig_path = self._memo.get(memo_key)
+            if fig_path is not None:
+                self._memo.move_to_end(memo_key)
+                return fig_path
+
+        raw = base64.b64decode(data)
+        digest = hashlib.sha256(raw).hexdigest()
+        ext = mimetypes.guess_extension(fmt) or ''
+        fig_path = os.path.join(self.path, f'{digest}{ext}')
+        if not os.path.exists(fig_path):
+            _write_atomic(fig_path, raw, compress=False, mode=FILE_MODE)
+
+        with self._lock:
+            self._memo[memo_key] = fig_path
+            if len(self._memo) > self.memo_size:
+                self._memo.popitem(last=False)
+        return fig_path
+
+
+@lru_cache(maxsize=None)
+def _get_store(abs_path):
+    return FigureStore(abs_path)
+
+
+def get_store(path):
+    """Return the store at `path`, shared by all renders in this process."""
+    return _get_store(os.path.abspath(path))
@@ -0,0 +1,206 @@
+"""Journal of a render's progress, for `nestler --journal` and `--resume`.
+
+As a document is evaluated, the result of each code part is appended to the
+journal, and every so often the kernel's whole namespace is saved to a
+checkpoint. Saving the namespace can take as long as the chunks did, so by
+default a checkpoint is only made once the chunks since the last one took a
+while to run, and much longer than the last checkpoint took to save. A
+resumed render restores the last checkpoint that the document still matches,
+takes the results of the code parts before it from the journal, and evaluates
+the rest.
+"""
+import logging
+import os
+import pickle
+import shutil
+import time
+
+from . import __version__
+from . import execute
+from .constants import ChunkOption
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHECKPOINT_SECONDS = 10
+
+# How many times longer than the last checkpoint took to save the chunks
+# since it must have taken to run, for another checkpoint to be worth it.
+CHECKPOINT_COST_RATIO = 5
+
+RECORDS_NAME = 'journal.pickle'
+
+
+def journal_path(out_path_base):
+    return os.path.join(f'{out_path_base}_files', 'journal')
+
+
+def _read_records(path):
+    records = []
+    try:
+        f = open(path, 'rb')
+    except FileNotFoundError:
+        return records
+    with f:
+        while True:
+            try:
+                records.append(pickle.load(f))
+            except EOFError:
+                break
+            except Exception:
+                # Such as a record cut short by a crash.
+                logger.warning('Ignoring the end of a damaged journal.')
+                break
+    return records
+
+
+class Journal:
+    """The journal of the renders of one document, in directory `path`.
+
+    A checkpoint is made after every `checkpoint_every` chunks if that is
+    given, or else once the chunks since the last checkpoint took at least
+    `checkpoint_seconds`, unless a chunk's `checkpoint` option says
+    otherwise.
+    """
+
+    def __init__(self, path, checkpoint_every=None,
+                 checkpoint_seconds=DEFAULT_CHECKPOINT_SECONDS,
+                 compress=False):
+        self.path = path
+        self.checkpoint_every = checkpoint_every
+        self.checkpoint_seconds = checkpoint_seconds
+        self.compress = compress
+        # The results of the code parts to take from the journal, and the
+        # checkpoint of the namespace after them.
+        self.resumed_results = []
+        self._resumed_checkpoint = None
+        self._checkpoint = None
+        self._n_done = 0
+        self._chunks_since_checkpoint = 0
+        self._last_checkpoint_time = time.perf_counter()
+        self._checkpoint_duration = 0
+        self._file = None
+
+    def _checkpoint_path(self, n_done):
+        return os.path.abspath(os.path.join(self.path,
+                                            f'checkpoint-{n_done}.ns'))
+
+    def _find_resume_point(self, code_parts):
+        records = _read_records(os.path.join(self.path, RECORDS_NAME))
+        if not records or records[0] != ('start', __version__):
+            return [], None
+        results = []
+        resume = [], None
+        for kind, *args in records[1:]:
+            if kind == 'part':
+                part, part_evaled = args
+                i = len(results)
+                if i >= len(code_parts) or code_parts[i] != part:
+                    break
+                results.append(part_evaled)
+            elif kind == 'checkpoint':
+                n_done, = args
+                if os.path.exists(self._checkpoint_path(n_done)):
+                    resume = results[:n_done], n_done
+        return resume
+
+    def start(self, code_parts, resume=False):
+        """Begin the journal of a render of a document with `code_parts`.
+
+        To resume, keep the results up to the last checkpoint that the
+        document's code still matches, and start again from there.
+        """
+        if resume:
+            self.resumed_results, self._resumed_checkpoint = (
+                self._find_resume_point(code_parts)
+            )
+        if self._resumed_checkpoint is None:
+            logger.info('Starting a new journal.')
+            shutil.rmtree(self.path, ignore_errors=True)
+        else:
+            logger.warning(f'Resuming after {len(self.resumed_results)} '
+                           f'code parts from the journal.')
+        os.makedirs(self.path, exist_ok=True)
+        self._n_done = len(self.resumed_results)
+        self._checkpoint = self._resumed_checkpoint
+        # Write the journal again with just what is kept.
+        records_path = os.path.join(self.path, RECORDS_NAME)
+        self._file = open(f'{records_path}.part', 'wb')
+        self._append(('start', __version__))
+        for part, part_evaled in zip(code_parts, self.resumed_results):
+            self._append(('part', part, part_evaled))
+        if self._checkpoint is not None:
+            self._append(('checkpoint', self._checkpoint))
+        os.replace(f'{records_path}.part', records_path)
+        self._remove_other_checkpoints()
+        self._last_checkpoint_time = time.perf_counter()
+
+    def _append(self, record):
+        pickle.dump(record, self._file, pickle.HIGHEST_PROTOCOL)
+        self._file.flush()
+
+    def _remove_other_checkpoints(self):
+        keep = (None if self._checkpoint is None
+                else os.path.basename(self._checkpoint_path(self._checkpoint)))
+        for entry in os.scandir(self.path):
+            if entry.name.startswith('checkpoint-') and entry.name != keep:
+                os.remove(entry.path)
+
+    def restore(self, client):
+        """Load the checkpoint to resume from into the kernel."""
+        if self._resumed_checkpoint is None:
+            return
+        logger.info('Restoring the kernel from the journal\'s checkpoint...')
+        outs = execute.exec_kernel_function(
+            client, 'nestler.cache', 'restore',
+            self._checkpoint_path(self._resumed_checkpoint),
+        )
+        for content in outs.get('stderr', []):
+            logger.warning(content)
+        # Don't count the restore as time spent running chunks.
+        self._last_checkpoint_time = time.perf_counter()
+
+    def record(self, part, part_evaled):
+        self._append(('part', part, part_evaled))
+        self._n_done += 1
+
+    def _checkpoint_due(self):
+        if self.checkpoint_every is not None:
+            return self._chunks_since_checkpoint >= self.checkpoint_every
+        run_seconds = time.perf_counter() - self._last_checkpoint_time
+        return run_seconds >= max(
+            self.checkpoint_seconds,
+            CHECKPOINT_COST_RATIO * self._checkpoint_duration,
+        )
+
+    def chunk_done(self, client, options):
+        """Save a checkpoint after a chunk, if one is due."""
+        self._chunks_since_checkpoint += 1
+        wanted = options[ChunkOption.checkpoint]
+        if wanted is None:
+            wanted = self._checkpoint_due()
+        if not wanted:
+            return
+        logger.info(f'Saving a checkpoint after {self._n_done} code parts.')
+        start = time.perf_counter()
+        outs = execute.exec_kernel_function(
+            client, 'nestler.cache', 'checkpoint',
+            self._checkpoint_path(self._n_done), self.compress,
+        )
+        self._last_checkpoint_time = time.perf_counter()
+        self._checkpoint_duration = self._last_checkpoint_time - start
+        # Variables that can't be saved are left out, with a warning.
+        for content in outs.get('stderr', []):
+            logger.warning(content)
+        self._append(('checkpoint', self._n_done))
+        self._checkpoint = self._n_done
+        self._chunks_since_checkpoint = 0
+        self._remove_other_checkpoints()
+
+    def finish(self):
+        """Remove the journal, once the render has succeeded."""
+        self._file.close()
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def close(self):
+        if self._file is not None and not self._file.closed:
+            self._file.close()
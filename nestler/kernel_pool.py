@@ -0,0 +1,110 @@
+"""Kernels booted ahead of time, to hand out to documents in turn."""
+import logging
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from . import execute
+from . import trace
+
+logger = logging.getLogger(__name__)
+
+
+class KernelPool:
+    """A fixed number of kernels, with the preamble loaded.
+
+    Each kernel's namespace is reset when it is given back. A kernel is
+    replaced by a fresh one after `max_uses` documents, if it is using more
+    than `max_memory_bytes` of memory when given back, or if a request to it
+    timed out.
+    """
+
+    def __init__(self, size, max_uses=None, max_memory_bytes=None):
+        self.max_uses = max_uses
+        self.max_memory_bytes = max_memory_bytes
+        self._idle = queue.Queue()
+        self._uses = {}
+        self._lock = threading.Lock()
+        self._closed = False
+        # Boot the kernels side by side, as each mostly waits on its process.
+        with ThreadPoolExecutor(max_workers=size) as executor:
+            for client in executor.map(lambda _: self._boot(), range(size)):
+                self._idle.put(client)
+
+    def _boot(self):
+        logger.info('Booting pool kernel...')
+        with trace.span('boot kernel', 'kernel'):
+            client = execute.get_kernel_client()
+            execute.load_preamble(client)
+        self._uses[client] = 0
+        logger.info('Booted pool kernel.')
+        return client
+
+    def _replace(self, client):
+        execute.shutdown(client)
+        del self._uses[client]
+        with self._lock:
+            if not self._closed:
+                self._idle.put(self._boot())
+
+    def _memory_bytes(self, client):
+        outs = execute.exec_kernel_function(
+            client, 'nestler.preamble', '_memory_bytes',
+            implicit_display=True,
+        )
+        try:
+            return int(outs['text'][0])
+        except (KeyError, ValueError):
+            # Such as when not on Linux.
+            return None
+
+    def _needs_replacing(self, client):
+        if self.max_uses is not None and self._uses[client] >= self.max_uses:
+            logger.info('Replacing pool kernel: used too many times')
+            return True
+        if self.max_memory_bytes is not None:
+            memory_bytes = self._memory_bytes(client)
+            if (memory_bytes is not None
+                    and memory_bytes > self.max_memory_bytes):
+                logger.info('Replacing pool kernel: using too much memory')
+                return True
+        return False
+
+    def acquire(self):
+        with trace.span('acquire kernel', 'kernel'):
+            return self._idle.get()
+
+    def release(self, client, replace=False):
+        self._uses[client] += 1
+        if replace or self._needs_replacing(client):
+            # Boot the replacement in the background, so the caller can get
+            # on with its next document.
+            threading.Thread(target=self._replace, args=(client,),
+                             daemon=True).start()
+        else:
+            execute.exec_kernel_function(client, 'nestler.preamble', '_reset')
+            self._idle.put(client)
+
+    @contextmanager
+    def kernel(self):
+        client = self.acquire()
+        replace = False
+        try:
+            yield client
+        except TimeoutError:
+            # The kernel may still be running the code that timed out.
+            replace = True
+            raise
+        finally:
+            self.release(client, replace=replace)
+
+    def shutdown(self):
+        with self._lock:
+            self._closed = True
+        while True:
+            try:
+                client = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            execute.shutdown(client)
@@ -0,0 +1,250 @@
+"""Interpreting the messages a kernel sends about the requests it runs."""
+import base64
+import logging
+import os
+import tempfile
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+
+
+# Mode of files of spilled output, which are served with documents.
+SPILL_FILE_MODE = 0o644
+
+
+def _count_lines(text):
+    # As `OutputLimiter.take` slices text, so a partial last line counts, as
+    # do lines ended by '\r' alone, as progress bars write.
+    return len(text.splitlines())
+
+
+class OutputLimiter:
+    """Keep a request's text output within limits as it is received.
+
+    Output beyond `max_lines` lines or `max_bytes` bytes is written to a file
+    in `spill_dir` instead of being kept, and so is everything after it, to
+    keep the file in order. Images don't count towards the limits.
+    """
+
+    def __init__(self, spill_dir=None, max_lines=None, max_bytes=None):
+        self.spill_dir = spill_dir
+        self.max_lines = max_lines
+        self.max_bytes = max_bytes
+        self.n_lines = 0
+        self.n_bytes = 0
+        self.spilled_lines = 0
+        self.spilled_bytes = 0
+        self.path = None
+        self._file = None
+
+    def _spill(self, text):
+        if self._file is None:
+            if self.spill_dir is not None:
+                os.makedirs(self.spill_dir, exist_ok=True)
+            fd, self.path = tempfile.mkstemp(
+                dir=self.spill_dir, prefix='output-', suffix='.txt')
+            os.chmod(self.path, SPILL_FILE_MODE)
+            self._file = open(fd, 'w', encoding='utf-8')
+        self._file.write(text)
+        self.spilled_lines += _count_lines(text)
+        self.spilled_bytes += len(text.encode())
+
+    def take(self, text):
+        """Return the start of `text` that is within the limits.
+
+        The rest is spilled.
+        """
+        if self._file is not None:
+            self._spill(text)
+            return ''
+        kept = text
+        if self.max_lines is not None:
+            room = max(self.max_lines - self.n_lines, 0)
+            kept = ''.join(kept.splitlines(keepends=True)[:room])
+        if self.max_bytes is not None:
+            room = max(self.max_bytes - self.n_bytes, 0)
+            kept = kept.encode()[:room].decode(errors='ignore')
+        self.n_lines += _count_lines(kept)
+        self.n_bytes += len(kept.encode())
+        if len(kept) < len(text):
+            self._spill(text[len(kept):])
+        return kept
+
+    def take_data(self, data):
+        """Return whether to keep a rich output with `data`.
+
+        An output that doesn't fit whole is spilled.
+        """
+        if any(datum_type.startswith('image/') for datum_type in data):
+            return True
+        text = data.get('text/html', data.get('text/plain'))
+        if not isinstance(text, str):
+            return True
+        n_lines = _count_lines(text)
+        n_bytes = len(text.encode())
+        fits = (
+            self._file is None
+            and (self.max_lines is None
+                 or self.n_lines + n_lines <= self.max_lines)
+            and (self.max_bytes is None
+                 or self.n_bytes + n_bytes <= self.max_bytes)
+        )
+        if fits:
+            self.n_lines += n_lines
+            self.n_bytes += n_bytes
+        else:
+            self._spill(text if text.endswith('\n') else text + '\n')
+        return fits
+
+    def close(self):
+        """Return a reply that says what was spilled, if anything was."""
+        if self._file is None:
+            return None
+        self._file.close()
+        return {
+            'msg_type': 'truncated',
+            'metadata': {},
+            'content': {
+                'path': self.path,
+                'lines': self.spilled_lines,
+                'bytes': self.spilled_bytes,
+            },
+        }
+
+
+def add_reply(replies, reply, limiter=None):
+    # Return whether the kernel has finished the request.
+    c = reply['content']
+    msg_type = reply['msg_type']
+    if msg_type == 'stream':
+        logger.debug(f"Got {msg_type} reply: '{c}'")
+        if limiter is not None:
+            text = limiter.take(c['text'])
+            if not text:
+                return False
+            reply = dict(reply, content=dict(c, text=text))
+        replies.append(reply)
+    elif msg_type == 'execute_input':
+        logger.debug(f"Executing:\n```\n{c['code']}\n```")
+    elif msg_type in ('execute_result', 'display_data'):
+        logger.debug(f"Got {msg_type} reply: '{c}'")
+        if limiter is None or limiter.take_data(c['data']):
+            replies.append(reply)
+    elif msg_type == 'status':
+        status = c['execution_state']
+        logger.info(f"Kernel is '{status}'")
+        if status == 'idle':
+            logger.info('All messages received')
+            return True
+    elif msg_type == 'error':
+        replies.append(reply)
+    else:
+        raise NotImplementedError(reply)
+    return False
+
+
+ExecOutput = namedtuple('ExecOutput', 'kind content')
+
+
+# Image types that are sent base64-encoded, and those sent as text.
+BASE64_IMAGE_TYPES = ('image/png', 'image/jpeg', 'image/webp')
+TEXT_IMAGE_TYPES = ('image/svg+xml',)
+
+
+def interpret_replies(replies):
+    outs = {}
+    for reply in replies:
+        msg_type = reply['msg_type']
+        if reply['metadata']:
+            # Such as image sizes, which the output formats don't use.
+            logger.debug(f"Ignoring {msg_type} metadata: "
+                         f"{reply['metadata']}")
+        if msg_type in ('execute_result', 'display_data'):
+            data = reply[u'content'][u'data']
+            for datum_type, datum in data.items():
+                if datum_type == 'text/plain':
+                    if msg_type == 'display_data':
+                        kind = 'display_text'
+                    else:
+                        kind = 'text'
+                    outs.setdefault(kind, []).append(
+                        datum.strip("'")
+                    )
+                elif datum_type == 'text/html':
+                    outs.setdefault('html', []).append(
+                        datum
+                    )
+                elif datum_type in BASE64_IMAGE_TYPES + TEXT_IMAGE_TYPES:
+                    if datum_type in TEXT_IMAGE_TYPES:
+                        # Keep all images in the same encoding.
+                        datum = base64.b64encode(datum.encode()).decode()
+                    outs.setdefault('image', []).append(
+                        {
+                            'format': datum_type,
+                            'data': datum,
+                            'slug': None,
+                            'caption': None,
+                        },
+                    )
+                elif datum_type == 'application/javascript':
+                    outs.setdefault('script', []).append(
+                        datum,
+                    )
+                elif datum_type == 'application/vnd.bokehjs_load.v0+json':
+                    outs.setdefault('script', []).append(
+                        datum,
+                    )
+                elif datum_type == 'application/json':
+                    if datum.get('kind') == 'caption':
+                        outs.setdefault('caption', []).append(
+                            datum
+                        )
+                    else:
+                        raise NotImplementedError(datum)
+                else:
+                    raise NotImplementedError(datum_type)
+        elif msg_type == 'stream':
+            txt = reply['content']['text'].rstrip()
+            stream_name = reply['content']['name']
+            outs.setdefault(stream_name, []).append(
+                txt,
+            )
+        elif msg_type == 'truncated':
+            outs.setdefault('truncated', []).append(reply['content'])
+        elif msg_type == 'error':
+            c = reply['content']
+            outs.setdefault('error', []).append(
+                {
+                    'name': c['ename'],
+                    'value': c['evalue'],
+                },
+            )
+        else:
+            raise NotImplementedError(msg_type)
+    for out, cap in zip(outs.get('image', []), outs.get('caption', [])):
+        out['slug'] = cap['slug']
+        out['caption'] = cap['caption']
+    outs.pop('caption', None)
+    return outs
+
+
+def expression_outs(result):
+    if result['status'] != 'ok':
+        return {
+            'error': [{'name': result['ename'], 'value': result['evalue']}],
+        }
+    data = result['data']
+    # The display hook shows nothing for None, so neither does an expression
+    # that gives it, as when it is run as code.
+    if data.get('text/plain') == 'None':
+        return {}
+    return interpret_replies([{
+        'msg_type': 'execute_result',
+        'metadata': {},
+        'content': {'data': data},
+    }])
+
+
+def recover_exception(out):
+    sexc = f"{out['name']}: {out['value']}"
+    return sexc
@@ -1,11 +1,21 @@
 import logging
 import argparse
+import os
 import os.path as opath
+import sys
+from functools import partial
 
 from . import parseful as parse
-from .constants import ChunkOption
+from .constants import ChunkOption, FigureDevice, TableFormat
 from . import output_routines
 from . import start_kernel
+from . import cache
+from . import parse_cache
+from .journal import DEFAULT_CHECKPOINT_SECONDS, Journal, journal_path
+from . import batch
+from . import watch
+from . import trace
+from . import utils
 
 logger = logging.getLogger(__name__)
 
@@ -32,31 +42,180 @@ DEFAULT_CHUNK_OPTS = {
     ChunkOption.figure_caption: None,
     ChunkOption.figure_height: None,
     ChunkOption.figure_width: None,
+    ChunkOption.figure_device: FigureDevice.png,
+    ChunkOption.figure_dpi: None,
+    ChunkOption.figure_rasterize: False,
+    ChunkOption.figure_quantize: False,
+    ChunkOption.figure_compress_level: None,
+    ChunkOption.max_output_lines: None,
+    ChunkOption.max_output_bytes: None,
+    ChunkOption.output_path: None,
+    ChunkOption.checkpoint: None,
+    ChunkOption.table_max_rows: None,
+    ChunkOption.table_max_cols: None,
+    ChunkOption.table_format: TableFormat.auto,
 }
 
 
-def run(in_stream, out_path_base, connection_file=None):
-    logger.info('Reading file...')
-    md_in = in_stream.read()
-    logger.info('Read file.')
-
-    logger.info('Parsing file...')
-    header, parts = parse.parse(md_in)
-    logger.info('Parsed file.')
-
+def get_global_options(incremental=False, out_path_base=None,
+                       max_output_lines=None, max_output_bytes=None):
     default_options = DEFAULT_CHUNK_OPTS.copy()
     # TODO.
     global_options = default_options.copy()
+    if incremental:
+        # Cache every chunk unless it says otherwise, so that only the chunks
+        # affected by a change are run again.
+        global_options[ChunkOption.do_cache] = True
+    if out_path_base is not None:
+        # Spill output next to the document's other files.
+        global_options[ChunkOption.output_path] = f'{out_path_base}_files'
+    global_options[ChunkOption.max_output_lines] = max_output_lines
+    global_options[ChunkOption.max_output_bytes] = max_output_bytes
+    return global_options
 
+
+def get_output_routine_map(header):
+    # Look up all routines before running anything, to warn early. Formats
+    # that can't be rendered are skipped, so that the others still are.
+    output_routine_map = {}
     for output_fmt_str in header.get('output', {}):
+        try:
+            output_routine_map[output_fmt_str] = (
+                output_routines.get_output_routine(output_fmt_str)
+            )
+        except (ValueError, NotImplementedError) as e:
+            logger.warning(f'Not rendering "{output_fmt_str}": {e}')
+    return output_routine_map
+
+
+def get_doc_cache(parts, global_options, out_path_base,
+                  cache_max_bytes=cache.DEFAULT_MAX_BYTES,
+                  cache_compress=False):
+    return cache.DocumentCache(
+        output_routines.get_chunks(parts, global_options),
+        max_bytes=cache_max_bytes,
+        compress=cache_compress,
+        manifest_path=cache.manifest_path(
+            global_options[ChunkOption.cache_path], out_path_base,
+        ),
+    )
+
+
+def print_explanation(doc_cache):
+    for name, was_run, reason in doc_cache.explain():
+        print(f'{name}: {"run" if was_run else "not run"} ({reason})')
+
+
+def render_outputs(header, parts_evaled, out_path_base, output_routine_map):
+    """Render evaluated parts to each output format.
+
+    `parts_evaled` may be an iterator, which is only iterated over once.
+    """
+    def render(output_fmt_str, parts_evaled):
         logger.info(f'Rendering file to "{output_fmt_str}"...')
-        output_fmt = output_routines.OutputFormat(output_fmt_str)
-        output_routine = output_routines.FORMAT_TO_ROUTINE[output_fmt]
-        output_routine(header, parts, output_fmt_str, global_options,
-                       out_path_base,
-                       connection_file=connection_file)
+        output_routine = output_routine_map[output_fmt_str]
+        with trace.span(f'render {output_fmt_str}', 'render'):
+            output_routine(header, parts_evaled, output_fmt_str,
+                           out_path_base)
         logger.info(f'Rendered file to "{output_fmt_str}".')
 
+    if len(output_routine_map) == 1:
+        output_fmt_str, = output_routine_map
+        render(output_fmt_str, parts_evaled)
+    else:
+        # Each format is rendered from the same results, so the conversions,
+        # which mostly wait on pandoc, can run side by side.
+        utils.fan_out(parts_evaled, [
+            partial(render, output_fmt_str)
+            for output_fmt_str in output_routine_map
+        ])
+
+
+def run(in_stream, out_path_base, connection_file=None,
+        cache_max_bytes=cache.DEFAULT_MAX_BYTES, cache_compress=False,
+        incremental=False, explain=False, pipeline_depth=1,
+        kernel_pool=None, n_kernels=1, max_output_lines=None,
+        max_output_bytes=None, parse_cache_path=None, journal=False,
+        resume=False, checkpoint_every=None,
+        checkpoint_seconds=DEFAULT_CHECKPOINT_SECONDS):
+    global_options = get_global_options(
+        incremental=incremental,
+        out_path_base=out_path_base,
+        max_output_lines=max_output_lines,
+        max_output_bytes=max_output_bytes,
+    )
+    # Evaluate and render one part at a time, as it is read, unless a mode
+    # that needs all the parts at once is asked for. A journal records the
+    # parts as they are evaluated this way, so needs it.
+    journal = journal or resume
+    stream = (pipeline_depth == 1 and n_kernels == 1
+              and (in_stream.seekable() or journal))
+
+    logger.info('Parsing file...')
+    with trace.span('parse', 'parse'):
+        if parse_cache_path is None:
+            header, parts = parse.parse_stream(in_stream)
+        else:
+            header, parts = parse_cache.ParseCache(
+                parse_cache_path).parse_stream(in_stream)
+        output_routine_map = get_output_routine_map(header)
+        if not output_routine_map:
+            return
+        # Parts that are already all in memory, such as from the cache,
+        # needn't be read again.
+        reread = (stream and in_stream.seekable()
+                  and not isinstance(parts, list))
+        if not reread:
+            parts = list(parts)
+        # Keep just the code, to find the dependencies between chunks. When
+        # reread, the parts are read again as they are evaluated.
+        code_parts = [part for part in parts if not isinstance(part, str)]
+    logger.info('Parsed file.')
+
+    doc_cache = get_doc_cache(code_parts, global_options, out_path_base,
+                              cache_max_bytes=cache_max_bytes,
+                              cache_compress=cache_compress)
+    doc_journal = None
+    if journal:
+        doc_journal = Journal(journal_path(out_path_base),
+                              checkpoint_every=checkpoint_every,
+                              checkpoint_seconds=checkpoint_seconds,
+                              compress=cache_compress)
+        doc_journal.start(code_parts, resume=resume)
+    if reread:
+        in_stream.seek(0)
+        _, parts = parse.parse_stream(in_stream)
+    if stream:
+        parts_evaled = output_routines.iter_evaluate_parts(
+            parts, global_options, doc_cache,
+            connection_file=connection_file,
+            kernel_pool=kernel_pool,
+            journal=doc_journal,
+        )
+    else:
+        logger.info('Evaluating parsed document...')
+        parts_evaled = output_routines.evaluate_parts(
+            parts, global_options,
+            connection_file=connection_file,
+            doc_cache=doc_cache,
+            pipeline_depth=pipeline_depth,
+            kernel_pool=kernel_pool,
+            n_kernels=n_kernels,
+        )
+        logger.info('Evaluated parsed document.')
+
+    try:
+        render_outputs(header, parts_evaled, out_path_base,
+                       output_routine_map)
+    finally:
+        if doc_journal is not None:
+            doc_journal.close()
+    if doc_journal is not None:
+        doc_journal.finish()
+
+    if explain:
+        print_explanation(doc_cache)
+
 
 def set_log_level(verbose_count):
     # Set log level to WARN for 1, then increase verbosity with each increment.
@@ -65,17 +224,92 @@ def set_log_level(verbose_count):
 
 
 def main():
-    parser = argparse.ArgumentParser(description='')
+    if sys.argv[1:2] == ['serve']:
+        from . import serve
+        serve.main(sys.argv[2:])
+        return
+    parser = argparse.ArgumentParser(
+        description='',
+        epilog='To render documents sent to a long-running server instead, '
+               'see "nestler serve --help".',
+    )
     parser.add_argument(
-        'in_file',
-        type=argparse.FileType('r'),
+        'in_files',
+        nargs='+',
         # This is my preferred name for 'usage' purposes, but I can't use it
         # internally as it's a keyword.
-        metavar='input'
+        metavar='input',
+        help='Input files, directories of them, or glob patterns.',
     )
     parser.add_argument('-e', '--existing',
-                        default=start_kernel.DEFAULT_CONNECTION_FILE,
-                        help='Kernel connection file.')
+                        help='Kernel connection file. Defaults to '
+                             f'"{start_kernel.DEFAULT_CONNECTION_FILE}" when '
+                             'rendering one document.')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+                        help='Number of documents to render at once, when '
+                             'given several.')
+    parser.add_argument('--cache-size', type=float,
+                        default=cache.DEFAULT_MAX_BYTES / 2 ** 20,
+                        help='Size limit of each chunk cache, in megabytes.')
+    parser.add_argument('--cache-compress', default=False,
+                        action='store_true',
+                        help='Compress new chunk cache entries.')
+    parser.add_argument('--incremental', default=False,
+                        action='store_true',
+                        help='Cache all chunks by default, so that a render '
+                             'only runs chunks affected by changes.')
+    parser.add_argument('--explain', default=False, action='store_true',
+                        help='Print why each chunk was or was not run.')
+    parser.add_argument('--pipeline-depth', type=int, default=1,
+                        help='Number of code parts to queue on the kernel at '
+                             'once. Above 1, the kernel runs the next part '
+                             'while the last one\'s outputs are handled.')
+    parser.add_argument('-k', '--kernels', type=int, default=1,
+                        help='Number of kernels to run independent sections '
+                             'of a document on at once. This assumes chunks '
+                             'only share state through variables, and runs '
+                             'setup chunks once per section that needs '
+                             'them.')
+    parser.add_argument('-w', '--watch', default=False, action='store_true',
+                        help='Render the document again each time it is '
+                             'saved, only running code from the last '
+                             'checkpoint before the first changed code '
+                             'part onward.')
+    parser.add_argument('--trace', metavar='OUT_JSON',
+                        help='Write the time taken by each step of the '
+                             'render to a Chrome trace file, and print the '
+                             'slowest chunks.')
+    parser.add_argument('--parse-cache', nargs='?',
+                        const=parse_cache.DEFAULT_PATH, metavar='DIR',
+                        help='Keep parsed documents in a cache, by default '
+                             f'in "{parse_cache.DEFAULT_PATH}", so unchanged '
+                             'documents aren\'t parsed again.')
+    parser.add_argument('--max-output-lines', type=int,
+                        help='Most lines of text output to show per chunk, '
+                             'unless a chunk sets max_output_lines. The rest '
+                             'is saved to a file that the document links to.')
+    parser.add_argument('--max-output-bytes', type=int,
+                        help='Most bytes of text output to show per chunk, '
+                             'unless a chunk sets max_output_bytes.')
+    parser.add_argument('--journal', default=False, action='store_true',
+                        help='Record each code part\'s result, and '
+                             'checkpoint the kernel\'s variables, as the '
+                             'document renders, so that a failed render can '
+                             'be resumed.')
+    parser.add_argument('--resume', default=False, action='store_true',
+                        help='Resume a failed render from its journal\'s '
+                             'last checkpoint. Implies --journal.')
+    parser.add_argument('--checkpoint-every', type=int, metavar='N',
+                        help='Checkpoint the kernel\'s variables after every '
+                             'N chunks, unless a chunk sets checkpoint. By '
+                             'default, a checkpoint is made once the chunks '
+                             'since the last one took --checkpoint-seconds '
+                             'to run, and much longer than that checkpoint '
+                             'took to save.')
+    parser.add_argument('--checkpoint-seconds', type=float,
+                        default=DEFAULT_CHECKPOINT_SECONDS, metavar='S',
+                        help='Least seconds of running chunks between '
+                             'checkpoints, without --checkpoint-every.')
     parser.add_argument('-v', '--verbose', dest='verbose_count',
                         action='count', default=0,
                         help='Each occurrence increases log verbosity.')
@@ -84,6 +318,78 @@ def main():
     set_log_level(args.verbose_count)
 
     logging.basicConfig(level=logging.INFO)
-    out_path_base = opath.splitext(args.in_file.name)[0]
-    run(args.in_file, out_path_base,
-        connection_file=args.existing)
+    in_paths = batch.find_inputs(args.in_files)
+    if not in_paths:
+        parser.error('No input files found.')
+    if args.jobs < 1:
+        parser.error('--jobs must be at least 1.')
+    if args.journal or args.resume:
+        if args.watch:
+            parser.error('Can\'t journal a watched document.')
+        if args.pipeline_depth > 1 or args.kernels > 1:
+            parser.error('A journal records code parts in order, so can\'t '
+                         'use --pipeline-depth or --kernels.')
+        if args.checkpoint_every is not None and args.checkpoint_every < 1:
+            parser.error('--checkpoint-every must be at least 1.')
+    run_kwargs = dict(
+        cache_max_bytes=int(args.cache_size * 2 ** 20),
+        cache_compress=args.cache_compress,
+        incremental=args.incremental,
+        explain=args.explain,
+        pipeline_depth=args.pipeline_depth,
+        max_output_lines=args.max_output_lines,
+        max_output_bytes=args.max_output_bytes,
+        parse_cache_path=args.parse_cache,
+    )
+    journal_kwargs = dict(
+        journal=args.journal,
+        resume=args.resume,
+        checkpoint_every=args.checkpoint_every,
+        checkpoint_seconds=args.checkpoint_seconds,
+    )
+    if len(in_paths) == 1:
+        in_path = in_paths[0]
+        connection_file = args.existing
+        if connection_file is None:
+            connection_file = start_kernel.DEFAULT_CONNECTION_FILE
+        out_path_base = opath.splitext(in_path)[0]
+        if args.kernels > 1:
+            if args.existing is not None:
+                parser.error('Independent sections run on their own '
+                             'kernels, so can\'t use --existing.')
+            if args.watch:
+                parser.error('Can\'t watch a document with several kernels.')
+        if args.trace is not None:
+            trace.start()
+        try:
+            if args.watch:
+                watch.watch(in_path, out_path_base,
+                            connection_file=connection_file,
+                            **run_kwargs)
+            else:
+                with open(in_path) as in_file:
+                    run(in_file, out_path_base,
+                        connection_file=connection_file,
+                        n_kernels=args.kernels,
+                        **run_kwargs, **journal_kwargs)
+        finally:
+            tracer = trace.stop()
+            if tracer is not None:
+                tracer.write(args.trace)
+                trace.print_summary(tracer)
+    else:
+        if args.watch:
+            parser.error('Can only watch one document.')
+        if args.trace is not None:
+            parser.error('Can only trace one document.')
+        if args.kernels > 1:
+            parser.error('Documents rendered together each use one kernel, '
+                         'so can\'t use --kernels.')
+        if args.existing is not None:
+            parser.error('Documents rendered together each need their own '
+                         'kernel, so can\'t use --existing.')
+        results = batch.render_files(in_paths, jobs=args.jobs, **run_kwargs,
+                                     **journal_kwargs)
+        batch.print_summary(results)
+        if any(result.error is not None for result in results):
+            sys.exit(1)
@@ -1,7 +1,7 @@
 from decimal import Decimal
 
 from . import parseful as parse
-from .constants import ChunkOption, ResultsStyle
+from .constants import ChunkOption, ResultsStyle, FigureDevice, TableFormat
 
 
 BOOLEAN_CHUNK_OPTS = (
@@ -15,6 +15,15 @@ BOOLEAN_CHUNK_OPTS = (
     ChunkOption.show_warnings,
     ChunkOption.show_messages,
     ChunkOption.collapse_results,
+    ChunkOption.figure_rasterize,
+    ChunkOption.figure_quantize,
+    ChunkOption.checkpoint,
+)
+
+FLOAT_CHUNK_OPTS = (
+    ChunkOption.figure_height,
+    ChunkOption.figure_width,
+    ChunkOption.figure_dpi,
 )
 
 
@@ -47,6 +56,32 @@ def coerce_val_to_boolean(value_raw):
             raise ValueError(value_raw)
 
 
+def coerce_val_to_float(value_raw):
+    if isinstance(value_raw, Decimal):
+        return float(value_raw)
+    else:
+        raise ValueError(value_raw)
+
+
+def coerce_val_to_count(value_raw):
+    # A whole number, or none for no limit.
+    if not isinstance(value_raw, Decimal):
+        if coerce_val_to_boolean(value_raw) is None:
+            return None
+        raise ValueError(value_raw)
+    if value_raw != value_raw.to_integral_value() or value_raw < 0:
+        raise ValueError(value_raw)
+    return int(value_raw)
+
+
+def coerce_val_to_chunk_refs(value_raw):
+    # Chunks are referred to by label, or by their number in the document.
+    if isinstance(value_raw, Decimal):
+        return (int(value_raw),)
+    val_str = coerce_val_to_str(value_raw)
+    return tuple(ref.strip() for ref in val_str.split(',') if ref.strip())
+
+
 def update_chunk_options(initial_options, new_options):
     opts = initial_options.copy()
     for opt_str, value_raw in new_options.items():
@@ -63,6 +98,25 @@ def update_chunk_options(initial_options, new_options):
             value = ResultsStyle(val_str)
         elif chunk_opt == ChunkOption.label:
             value = value_raw
+        elif chunk_opt in (ChunkOption.cache_path, ChunkOption.output_path):
+            value = coerce_val_to_str(value_raw)
+        elif chunk_opt == ChunkOption.chunk_dependencies:
+            value = coerce_val_to_chunk_refs(value_raw)
+        elif chunk_opt in FLOAT_CHUNK_OPTS:
+            value = coerce_val_to_float(value_raw)
+        elif chunk_opt == ChunkOption.figure_device:
+            value = FigureDevice(coerce_val_to_str(value_raw))
+        elif chunk_opt in (ChunkOption.max_output_lines,
+                           ChunkOption.max_output_bytes,
+                           ChunkOption.table_max_rows,
+                           ChunkOption.table_max_cols):
+            value = coerce_val_to_count(value_raw)
+        elif chunk_opt == ChunkOption.table_format:
+            value = TableFormat(coerce_val_to_str(value_raw))
+        elif chunk_opt == ChunkOption.figure_compress_level:
+            value = int(coerce_val_to_float(value_raw))
+            if not 0 <= value <= 9:
+                raise ValueError(value_raw)
         else:
             import pdb; pdb.set_trace()
             raise NotImplementedError((opt_str, value_raw))
@@ -1,28 +1,48 @@
 from enum import Enum
 import logging
 import os
-
-import pypandoc
-import yaml
-from jinja2 import FileSystemLoader, Environment
+import shutil
+import tempfile
+import time
+from collections import namedtuple, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, ExitStack
+from functools import lru_cache
 
 from .constants import ChunkOption, ResultsStyle
 from . import parseful as parse
 from . import execute
+from . import messages
+from . import cache
+from . import figures
+from . import trace
+from . import depgraph
+from . import parallel
+from .kernel_pool import KernelPool
 from .options import update_chunk_options
 from . import utils
 
 THIS_FILE_DIR_PATH = os.path.dirname(os.path.abspath(__file__))
 
 
-tmpl_env = Environment(
-    loader=FileSystemLoader(os.path.join(THIS_FILE_DIR_PATH, 'templates')),
-    trim_blocks=True,
-    lstrip_blocks=True
-)
+# Jinja is imported, and each template compiled, when first needed, so that
+# commands that render nothing don't wait on them.
+@lru_cache(maxsize=None)
+def get_tmpl_env():
+    from jinja2 import FileSystemLoader, Environment
+
+    return Environment(
+        loader=FileSystemLoader(os.path.join(THIS_FILE_DIR_PATH,
+                                             'templates')),
+        trim_blocks=True,
+        lstrip_blocks=True
+    )
+
+
+@lru_cache(maxsize=None)
+def get_template(name):
+    return get_tmpl_env().get_template(name)
 
-figure_tmpl = tmpl_env.get_template('embedded_figure.html')
-script_tmpl = tmpl_env.get_template('script.html')
 
 logger = logging.getLogger(__name__)
 
@@ -52,6 +72,10 @@ class RenderOption(Enum):
     figure_output_device = "dev"
     # Whether to render figures with captions.
     figure_caption = "fig_caption"
+    # Where to save figures as files, rather than embed them: true for the
+    # output's own directory of files, or the path of a directory to share
+    # between documents.
+    figure_store = "fig_store"
     # Height and width of figures, in inches.
     figure_height = "fig_height"
     # Syntax highlighting style, such as "tango", "pygments", "kate", "zenburn"
@@ -100,6 +124,7 @@ DEFAULT_RENDER_OPTS = {
     RenderOption.figure_output_device: 'pdf',
     RenderOption.slide_countdown_duration: None,
     RenderOption.figure_caption: None,
+    RenderOption.figure_store: None,
     RenderOption.figure_height: None,
     RenderOption.syntax_highlight_style: None,
     RenderOption.include_files: None,
@@ -191,7 +216,7 @@ def recover_inline_source(code):
 
 def render_inline(code, outs, raise_errors):
     for content in outs.pop('error', []):
-        sexc = execute.recover_exception(content)
+        sexc = messages.recover_exception(content)
         raise ValueError(f"Got exception: '{sexc}'")
 
     s = ''
@@ -220,7 +245,26 @@ def add_result(sects, r, options, raw):
         sects.append(v)
 
 
-def render_chunk(code, options, outs, raise_errors):
+def render_embedded_figure(content):
+    return get_template('embedded_figure.html').render(
+        fmt=content['format'],
+        data=content['data'],
+        slug=content['slug'],
+        caption=content['caption'],
+    )
+
+
+def render_truncation(content, options, out_dir=None):
+    path = content['path']
+    if out_dir is not None:
+        path = os.path.relpath(path, out_dir)
+    return (f'{options[ChunkOption.result_prefix]} ... {content["lines"]} '
+            f'more lines ({content["bytes"]} bytes) of output in '
+            f'[{os.path.basename(path)}]({path})')
+
+
+def render_chunk(code, options, outs, raise_errors,
+                 render_figure=render_embedded_figure, out_dir=None):
     sects = []
     add_chunk_code(sects, code, options)
 
@@ -228,13 +272,9 @@ def render_chunk(code, options, outs, raise_errors):
         # Ugly way to avoid printing standard 'Figure <>' return.
         pass
 
+    line_start = f'{options[ChunkOption.result_prefix]} '
     for content in outs.pop('text', []):
-        lines = content.strip().split('\n')
-        lines_prompt = [
-            f'{options[ChunkOption.result_prefix]} {ln}'
-            for ln in lines
-        ]
-        out = '\n'.join(lines_prompt)
+        out = line_start + content.strip().replace('\n', '\n' + line_start)
         add_result(sects, out, options, raw=content)
 
     for content in outs.pop('html', []):
@@ -244,23 +284,17 @@ def render_chunk(code, options, outs, raise_errors):
 
     for content in outs.pop('image', []):
         logger.info(f'Adding image')
-        el = figure_tmpl.render(
-            fmt=content['format'],
-            data=content['data'],
-            slug=content['slug'],
-            caption=content['caption'],
-        )
+        el = render_figure(content)
         add_result(sects, el, options, raw=content)
 
     for content in outs.pop('script', []):
         logger.info(f'Adding script: "{utils.trunc(content)}"')
-        el = script_tmpl.render(
+        el = get_template('script.html').render(
             content=content,
         )
         add_result(sects, el, options, raw=content)
 
     for content in outs.pop('stdout', []):
-        import pdb; pdb.set_trace()
         if options[ChunkOption.show_messages]:
             s = f'{options[ChunkOption.result_prefix]} "{content}"'
             add_result(sects, s, options, raw=content)
@@ -270,8 +304,12 @@ def render_chunk(code, options, outs, raise_errors):
             s = f'WARNING {options[ChunkOption.result_prefix]} "{content}"'
             add_result(sects, s, options, raw=content)
 
+    for content in outs.pop('truncated', []):
+        s = render_truncation(content, options, out_dir=out_dir)
+        add_result(sects, s, options, raw=s)
+
     for content in outs.pop('error', []):
-        sexc = execute.recover_exception(content)
+        sexc = messages.recover_exception(content)
         if raise_errors:
             raise ValueError(f"Got exception: '{sexc}'")
         else:
@@ -286,78 +324,602 @@ def render_chunk(code, options, outs, raise_errors):
     return s
 
 
-def _process_part(part, client, global_options):
+# A code chunk that has been run, with the outputs it produced, ready to be
+# rendered into any output format.
+EvaluatedChunk = namedtuple('EvaluatedChunk', ['code', 'options', 'outs'])
+
+
+def raise_chunk_errors(outs, raise_errors):
+    if raise_errors:
+        for content in outs.get('error', []):
+            sexc = messages.recover_exception(content)
+            raise ValueError(f"Got exception: '{sexc}'")
+
+
+def _log_kernel_warnings(outs):
+    for content in outs.get('stderr', []):
+        logger.warning(content)
+
+
+def get_figure_options(options):
+    # The options for the kernel's figure backend, and for `display_table`,
+    # as plain values.
+    return {
+        'width': options[ChunkOption.figure_width],
+        'height': options[ChunkOption.figure_height],
+        'device': options[ChunkOption.figure_device].value,
+        'dpi': options[ChunkOption.figure_dpi],
+        'rasterize': options[ChunkOption.figure_rasterize],
+        'quantize': options[ChunkOption.figure_quantize],
+        'compress_level': options[ChunkOption.figure_compress_level],
+        'table_max_rows': options[ChunkOption.table_max_rows],
+        'table_max_cols': options[ChunkOption.table_max_cols],
+        'table_format': options[ChunkOption.table_format].value,
+    }
+
+
+def get_output_limiter(options):
+    max_lines = options[ChunkOption.max_output_lines]
+    max_bytes = options[ChunkOption.max_output_bytes]
+    if max_lines is None and max_bytes is None:
+        return None
+    return messages.OutputLimiter(options[ChunkOption.output_path],
+                                 max_lines=max_lines, max_bytes=max_bytes)
+
+
+def _exec_cached_chunk(client, chunk_index, code, options, doc_cache):
+    store = doc_cache.store(options[ChunkOption.cache_path])
+    key = doc_cache.keys[chunk_index]
+    ns_path = store.namespace_path(key)
+    outs = store.get(key)
+    if outs is None:
+        logger.info(f'Cache miss for chunk "{key}", running it.')
+        execute.exec_kernel_function(client, 'nestler.cache', 'snapshot_begin')
+        outs = execute.exec_code(
+            client, code,
+            implicit_display=False,
+            figure_options=get_figure_options(options),
+            limiter=get_output_limiter(options),
+        )
+        # Don't cache failures, so that they are seen again next time.
+        if 'error' not in outs:
+            try:
+                _, written = depgraph.names_used(code)
+            except SyntaxError:
+                # Such as code with IPython magics, so save everything.
+                written = None
+            else:
+                written = sorted(written)
+            _log_kernel_warnings(execute.exec_kernel_function(
+                client, 'nestler.cache', 'snapshot_end',
+                ns_path, store.compress, written,
+            ))
+            store.put(key, outs)
+        doc_cache.runs[chunk_index] = 'run'
+    else:
+        logger.info(f'Cache hit for chunk "{key}", restoring its variables.')
+        _log_kernel_warnings(execute.exec_kernel_function(
+            client, 'nestler.cache', 'restore', ns_path,
+        ))
+        doc_cache.runs[chunk_index] = 'reused'
+    return outs
+
+
+def _part_options(part, global_options):
+    if isinstance(part, parse.CodeChunk):
+        return update_chunk_options(global_options, part.options)
+    else:
+        return global_options.copy()
+
+
+def _finish_part(part, options, outs):
+    raise_errors = not options[ChunkOption.show_errors]
+    if isinstance(part, parse.InlineCode):
+        return render_inline(part.code, outs, raise_errors=raise_errors)
+    else:
+        # Stop at the failing chunk, rather than once rendering starts.
+        raise_chunk_errors(outs, raise_errors=raise_errors)
+        return EvaluatedChunk(code=part.code, options=options, outs=outs)
+
+
+def _trace_name(part, options, chunk_index):
+    if isinstance(part, parse.CodeChunk):
+        return depgraph.chunk_name(chunk_index, options)
+    else:
+        return f'inline: {utils.trunc(part.code, lim=40)}'
+
+
+def _evaluate_part(part, client, global_options, doc_cache, chunk_index):
+    if isinstance(part, (parse.CodeChunk, parse.InlineCode)):
+        options = _part_options(part, global_options)
+        category = 'chunk' if isinstance(part, parse.CodeChunk) else 'inline'
+        with trace.span(_trace_name(part, options, chunk_index), category):
+            return _evaluate_code_part(part, client, global_options,
+                                       doc_cache, chunk_index)
+    elif isinstance(part, str):
+        return part
+    else:
+        raise Exception
+
+
+def _evaluate_code_part(part, client, global_options, doc_cache,
+                        chunk_index):
     if isinstance(part, parse.InlineCode):
         logger.info(f'Processing inline code: "{utils.trunc(part.code)}"...')
-        options = global_options.copy()
+        options = _part_options(part, global_options)
         if options[ChunkOption.run_code]:
             outs = execute.exec_code(
                 client,
                 part.code,
                 implicit_display=True,
             )
-            return render_inline(
-                part.code,
-                outs,
-                raise_errors=not options[ChunkOption.show_errors],
-            )
+            return _finish_part(part, options, outs)
         else:
             return recover_inline_source(part.code)
         logger.info('Processed inline code.')
     elif isinstance(part, parse.CodeChunk):
         logger.info(f'Processing code chunk: "{utils.trunc(part.code)}"...')
-        options = update_chunk_options(global_options, part.options)
+        options = _part_options(part, global_options)
         if options[ChunkOption.run_code]:
-            outs = execute.exec_code(
-                client,
-                part.code,
-                implicit_display=False,
-            )
-            return render_chunk(
-                part.code,
-                options,
-                outs,
-                raise_errors=not options[ChunkOption.show_errors],
-            )
+            if options[ChunkOption.do_cache]:
+                outs = _exec_cached_chunk(client, chunk_index, part.code,
+                                          options, doc_cache)
+            else:
+                outs = execute.exec_code(
+                    client,
+                    part.code,
+                    implicit_display=False,
+                    figure_options=get_figure_options(options),
+                    limiter=get_output_limiter(options),
+                )
+                doc_cache.runs[chunk_index] = 'uncached'
+            return _finish_part(part, options, outs)
         else:
             return recover_chunk_source(part.code)
-    elif isinstance(part, str):
-        return part
+
+
+def _finish_replies(part, options, replies):
+    return _finish_part(part, options, messages.interpret_replies(replies))
+
+
+def _evaluate_parts_pipelined(parts, client, global_options, doc_cache,
+                              pipeline_depth):
+    # Queue up to `pipeline_depth` requests on the kernel, so it can start on
+    # the next part while we take in the replies to the last one, which
+    # happens on a separate thread.
+    router = execute.ReplyRouter(client)
+    parts_evaled = [None] * len(parts)
+    in_flight = deque()
+    finishing = []
+
+    def collect(max_in_flight):
+        while len(in_flight) > max_in_flight:
+            i, part, options, msg_id, chunk_i, submitted = (
+                in_flight.popleft()
+            )
+            replies = router.wait(msg_id)
+            # Includes the time the part was queued behind others.
+            trace.add(
+                _trace_name(part, options, chunk_i),
+                'chunk' if isinstance(part, parse.CodeChunk) else 'inline',
+                submitted,
+            )
+            finishing.append(
+                (i, finisher.submit(_finish_replies, part, options, replies))
+            )
+            # Raise any error now, to stop where the serial mode stops. The
+            # kernel aborts the requests queued behind it.
+            if any(reply['msg_type'] == 'error' for reply in replies):
+                for _, future in finishing:
+                    future.result()
+
+    with ThreadPoolExecutor(max_workers=1) as finisher:
+        chunk_index = 0
+        for i, part in enumerate(parts):
+            is_chunk = isinstance(part, parse.CodeChunk)
+            options = _part_options(part, global_options)
+            if (isinstance(part, (parse.CodeChunk, parse.InlineCode))
+                    and options[ChunkOption.run_code]
+                    and not (is_chunk and options[ChunkOption.do_cache])):
+                logger.info(f'Queueing code: "{utils.trunc(part.code)}"...')
+                submitted = time.perf_counter()
+                msg_id = router.submit(
+                    part.code,
+                    implicit_display=not is_chunk,
+                    stop_on_error=not (
+                        is_chunk and options[ChunkOption.show_errors]
+                    ),
+                    figure_options=(get_figure_options(options) if is_chunk
+                                    else None),
+                    limiter=get_output_limiter(options) if is_chunk else None,
+                )
+                in_flight.append(
+                    (i, part, options, msg_id, chunk_index, submitted)
+                )
+                if is_chunk:
+                    doc_cache.runs[chunk_index] = 'uncached'
+                collect(pipeline_depth - 1)
+            else:
+                if is_chunk and options[ChunkOption.run_code]:
+                    # Cached chunks check the state of the kernel, so let it
+                    # catch up first.
+                    collect(0)
+                parts_evaled[i] = _evaluate_part(part, client, global_options,
+                                                 doc_cache, chunk_index)
+            if is_chunk:
+                chunk_index += 1
+        collect(0)
+        for i, future in finishing:
+            parts_evaled[i] = future.result()
+    return parts_evaled
+
+
+def _evaluate_section(section, parts, global_options, doc_cache,
+                      chunk_indexes, kernel_pool):
+    results = {}
+    with kernel_pool.kernel() as client:
+        for i in section.run:
+            r = _evaluate_part(parts[i], client, global_options, doc_cache,
+                               chunk_indexes.get(i))
+            # Other sections only ran the setup chunks they share for their
+            # side effects.
+            if i in section.owned:
+                results[i] = r
+    return results
+
+
+def _evaluate_parts_parallel(parts, global_options, doc_cache, kernel_pool,
+                             n_kernels):
+    sections = parallel.plan_sections(parts, doc_cache.nodes)
+    logger.info(f'Evaluating {len(sections)} independent sections on '
+                f'{n_kernels} kernels...')
+    chunk_indexes = {}
+    for i, part in enumerate(parts):
+        if isinstance(part, parse.CodeChunk):
+            chunk_indexes[i] = len(chunk_indexes)
+    # Text parts need no evaluating.
+    parts_evaled = list(parts)
+    with ThreadPoolExecutor(max_workers=n_kernels) as executor:
+        futures = [
+            executor.submit(_evaluate_section, section, parts, global_options,
+                            doc_cache, chunk_indexes, kernel_pool)
+            for section in sections
+        ]
+        # Raise the first error in document order.
+        for future in futures:
+            for i, r in future.result().items():
+                parts_evaled[i] = r
+    return parts_evaled
+
+
+def get_chunks(parts, global_options):
+    return [
+        (part.code, update_chunk_options(global_options, part.options))
+        for part in parts if isinstance(part, parse.CodeChunk)
+    ]
+
+
+@contextmanager
+def document_client(connection_file=None, kernel_pool=None):
+    if kernel_pool is not None:
+        with kernel_pool.kernel() as client:
+            yield client
     else:
-        raise Exception
+        with trace.span('boot kernel', 'kernel'):
+            client = execute.get_kernel_client(
+                connection_file=connection_file,
+            )
+        with trace.span('load preamble', 'kernel'):
+            execute.load_preamble(client)
+        try:
+            yield client
+        finally:
+            execute.shutdown(client)
 
 
-def process_parts(parts, header, global_options,
-                  connection_file=None):
-    client = execute.get_kernel_client(connection_file=connection_file)
+def evaluate_parts_with_client(parts, client, global_options, doc_cache,
+                               pipeline_depth=1):
+    if pipeline_depth > 1:
+        parts_evaled = _evaluate_parts_pipelined(
+            parts, client, global_options, doc_cache, pipeline_depth,
+        )
+    else:
+        parts_evaled = list(iter_evaluated_parts(
+            parts, client, global_options, doc_cache,
+        ))
+    doc_cache.save_manifest()
+    return parts_evaled
+
+
+# The most inline expressions to evaluate in one request, and the most text
+# to hold back from rendering while gathering them.
+INLINE_BATCH_SIZE = 256
+INLINE_BATCH_TEXT_LEN = 2 ** 20
+
+
+def _is_inline_expression(part, global_options):
+    if not (isinstance(part, parse.InlineCode)
+            and global_options[ChunkOption.run_code]):
+        return False
+    # Anything else, such as statements or IPython syntax, is run as code.
+    try:
+        compile(part.code, '<inline>', 'eval')
+    except SyntaxError:
+        return False
+    return True
+
+
+def _evaluate_inline_batch(parts, client, global_options):
+    # Evaluate the inline expressions among `parts` in one request, rather
+    # than a round trip to the kernel each.
+    expressions = [part for part in parts
+                   if isinstance(part, parse.InlineCode)]
+    logger.info(f'Processing {len(expressions)} inline expressions...')
+    with trace.span(f'inline: {len(expressions)} expressions', 'inline'):
+        results = iter(execute.eval_expressions(
+            client, [part.code for part in expressions],
+        ))
+    options = global_options.copy()
+    return [
+        part if isinstance(part, str)
+        else _finish_part(part, options, next(results))
+        for part in parts
+    ]
 
-    execute.exec_code(client, 'from nestler.preamble import *',
-                      implicit_display=False)
 
-    parts_evaled = []
+def _replay_journal(parts, client, journal, doc_cache, chunk_index):
+    # Yield the journal's results for the first code parts in `parts`, then
+    # restore the namespace after them, and return the next chunk's index.
+    for part_evaled in journal.resumed_results:
+        part = next(parts)
+        while isinstance(part, str):
+            yield part
+            part = next(parts)
+        if isinstance(part, parse.CodeChunk):
+            doc_cache.runs[chunk_index] = 'reused'
+            chunk_index += 1
+        yield part_evaled
+    journal.restore(client)
+    return chunk_index
+
+
+def _journaled(parts_evaled, parts, client, global_options, journal):
+    for part, part_evaled in zip(parts, parts_evaled):
+        if journal is not None and not isinstance(part, str):
+            journal.record(part, part_evaled)
+            if isinstance(part, parse.CodeChunk):
+                journal.chunk_done(client,
+                                   _part_options(part, global_options))
+        yield part_evaled
+
+
+def iter_evaluated_parts(parts, client, global_options, doc_cache,
+                         chunk_index=0, journal=None):
+    # Evaluate each part only when it is asked for, except that inline
+    # expressions are gathered, with the text between them, up to the next
+    # other code part, to evaluate together.
+    if journal is not None:
+        parts = iter(parts)
+        chunk_index = yield from _replay_journal(parts, client, journal,
+                                                 doc_cache, chunk_index)
+
+    def evaluate_batch(batch):
+        return _journaled(_evaluate_inline_batch(batch, client,
+                                                 global_options),
+                          batch, client, global_options, journal)
+
+    batch = []
+    n_expressions = 0
+    text_len = 0
     for part in parts:
-        r = _process_part(part, client, global_options)
-        parts_evaled.append(r)
+        if _is_inline_expression(part, global_options):
+            batch.append(part)
+            n_expressions += 1
+        elif isinstance(part, str) and batch:
+            batch.append(part)
+            text_len += len(part)
+        else:
+            if batch:
+                yield from evaluate_batch(batch)
+                batch, n_expressions, text_len = [], 0, 0
+            part_evaled = _evaluate_part(part, client, global_options,
+                                         doc_cache, chunk_index)
+            yield from _journaled([part_evaled], [part], client,
+                                  global_options, journal)
+            if isinstance(part, parse.CodeChunk):
+                chunk_index += 1
+            continue
+        if (n_expressions >= INLINE_BATCH_SIZE
+                or text_len >= INLINE_BATCH_TEXT_LEN):
+            yield from evaluate_batch(batch)
+            batch, n_expressions, text_len = [], 0, 0
+    if batch:
+        yield from evaluate_batch(batch)
+
+
+def iter_evaluate_parts(parts, global_options, doc_cache,
+                        connection_file=None, kernel_pool=None,
+                        journal=None):
+    """Yield each of `parts` evaluated, evaluating it when it is asked for.
+
+    `parts` may be an iterator, such as from `parseful.parse_stream`, so that
+    the document is read, evaluated and rendered a part at a time. With a
+    `journal.Journal`, each code part's result is recorded as it is yielded.
+    """
+    with document_client(connection_file=connection_file,
+                         kernel_pool=kernel_pool) as client:
+        yield from iter_evaluated_parts(parts, client, global_options,
+                                        doc_cache, journal=journal)
+    doc_cache.save_manifest()
+
+
+def evaluate_parts(parts, global_options, connection_file=None,
+                   doc_cache=None, pipeline_depth=1, kernel_pool=None,
+                   n_kernels=1):
+    if doc_cache is None:
+        doc_cache = cache.DocumentCache(get_chunks(parts, global_options))
+    if n_kernels > 1:
+        own_pool = kernel_pool is None
+        if own_pool:
+            kernel_pool = KernelPool(n_kernels)
+        try:
+            parts_evaled = _evaluate_parts_parallel(
+                parts, global_options, doc_cache, kernel_pool, n_kernels,
+            )
+        finally:
+            if own_pool:
+                kernel_pool.shutdown()
+        doc_cache.save_manifest()
+        return parts_evaled
+    with document_client(connection_file=connection_file,
+                         kernel_pool=kernel_pool) as client:
+        return evaluate_parts_with_client(
+            parts, client, global_options, doc_cache,
+            pipeline_depth=pipeline_depth,
+        )
+
+
+def _render_part(part_evaled, render_figure, out_dir=None):
+    if isinstance(part_evaled, EvaluatedChunk):
+        options = part_evaled.options
+        # Rendering consumes the outputs, so give it its own copy to allow
+        # rendering the same evaluated chunk to several formats.
+        return render_chunk(
+            part_evaled.code,
+            options,
+            dict(part_evaled.outs),
+            raise_errors=not options[ChunkOption.show_errors],
+            render_figure=render_figure,
+            out_dir=out_dir,
+        )
+    else:
+        return part_evaled
+
+
+def render_parts(parts_evaled, render_figure=render_embedded_figure,
+                 out_dir=None):
+    with trace.span('render parts', 'render'):
+        return ''.join(_render_part(p, render_figure, out_dir=out_dir)
+                       for p in parts_evaled)
+
+
+def write_parts(out_file, parts_evaled, render_figure=render_embedded_figure,
+                out_dir=None):
+    # Render and write one part at a time, so that only one is held in
+    # memory, even if `parts_evaled` is evaluated as it is iterated over.
+    with trace.span('render parts', 'render'):
+        for part_evaled in parts_evaled:
+            out_file.write(_render_part(part_evaled, render_figure,
+                                        out_dir=out_dir))
 
-    client.shutdown()
-    s = ''.join(parts_evaled)
+
+def process_parts(parts, header, global_options,
+                  connection_file=None, doc_cache=None):
+    parts_evaled = evaluate_parts(parts, global_options,
+                                  connection_file=connection_file,
+                                  doc_cache=doc_cache)
+    s = render_parts(parts_evaled)
     return s, header
 
 
+def get_scratch_dir(out_path_base):
+    # The directory for files that go with an output document.
+    scratch_dir = f'{out_path_base}_files'
+    os.makedirs(scratch_dir, exist_ok=True)
+    return scratch_dir
+
+
+def get_figure_store(render_options, out_path_base):
+    fig_store = render_options.get(RenderOption.figure_store)
+    if fig_store is None or fig_store is True:
+        return figures.get_store(get_scratch_dir(out_path_base))
+    else:
+        # Relative to the output document, like its scratch directory, so
+        # that the figures don't depend on where nestler is run from.
+        out_dir = os.path.dirname(os.path.abspath(out_path_base))
+        return figures.get_store(os.path.join(out_dir, fig_store))
+
+
+def _stored_figure_path(store, content, out_path_base):
+    # The path to the figure's file from the output's directory.
+    fig_path = store.put(content['format'], content['data'])
+    out_dir = os.path.dirname(os.path.abspath(out_path_base))
+    return os.path.relpath(fig_path, out_dir)
+
+
+def stored_figure_renderer(store, out_path_base):
+    """Return a figure renderer that saves each figure to `store`, and links
+    to it from an HTML figure."""
+    def render_figure(content):
+        return get_template('embedded_figure.html').render(
+            src=_stored_figure_path(store, content, out_path_base),
+            slug=content['slug'],
+            caption=content['caption'],
+        )
+    return render_figure
+
+
+def markdown_figure_renderer(store, out_path_base):
+    """Return a figure renderer that saves each figure to `store`, and links
+    to it with markdown image syntax."""
+    def render_figure(content):
+        fig_path = _stored_figure_path(store, content, out_path_base)
+        return f'![{content["caption"] or ""}]({fig_path})'
+    return render_figure
+
+
+@contextmanager
+def spool_file(out_path_base, keep_path=None):
+    """Give the path of a file to write a rendered document to, in the
+    output's directory of files.
+
+    Once done, the file is moved to `keep_path` if given, and otherwise
+    removed.
+    """
+    if keep_path is None:
+        fd, path = tempfile.mkstemp(dir=get_scratch_dir(out_path_base),
+                                    suffix='.md')
+        os.close(fd)
+    else:
+        path = f'{keep_path}.part'
+    try:
+        yield path
+    except BaseException:
+        if os.path.exists(path):
+            os.remove(path)
+        raise
+    if keep_path is None:
+        os.remove(path)
+    else:
+        os.replace(path, keep_path)
+
+
 def get_pandoc_var_args(k, v):
     return ['--variable', f'{k}={v}']
 
 
-def output_html_document(header, parts, output_fmt_str, global_options,
-                         out_path_base,
-                         connection_file=None):
+def get_pandoc_metadata(header):
+    import yaml
+
+    pandoc_header = header.copy()
+    pandoc_header.pop('output')
+    return yaml.dump(
+        pandoc_header,
+        default_flow_style=False,
+        indent=4
+    )
+
+
+def output_html_document(header, parts_evaled, output_fmt_str,
+                         out_path_base):
     render_options = update_render_options(DEFAULT_RENDER_OPTS,
                                            header['output'][output_fmt_str])
 
-    logger.info('Processing parsed document...')
-    md_out_str, header = process_parts(parts, header, global_options,
-                                       connection_file=connection_file)
-    logger.info('Processing parsed document.')
+    if render_options.get(RenderOption.figure_store):
+        store = get_figure_store(render_options, out_path_base)
+        render_figure = stored_figure_renderer(store, out_path_base)
+    else:
+        render_figure = render_embedded_figure
 
     logger.info('Building pandoc arguments...')
 
@@ -374,7 +936,7 @@ def output_html_document(header, parts, output_fmt_str, global_options,
         logger.info(f'Passing extra options to Pandoc: "{doc_pandoc_args}"')
         extra_pandoc_args.extend(doc_pandoc_args)
     # Add markdown extensions specified in the header to the defaults.
-    pandoc_md_extensions = DEFAULT_PANDOC_MD_EXTENSIONS
+    pandoc_md_extensions = DEFAULT_PANDOC_MD_EXTENSIONS[:]
     extra_md_extensions = render_options.get(RenderOption.markdown_extensions)
     if extra_md_extensions:
         ext_str = '\n'.join([f'    - {e}' for e in extra_md_extensions])
@@ -384,6 +946,9 @@ def output_html_document(header, parts, output_fmt_str, global_options,
     if render_options.get(RenderOption.make_self_contained):
         logger.info('Enabling "self-contained" option')
         extra_pandoc_args.append('--self-contained')
+        # Let pandoc find stored figures, to embed them.
+        out_dir = os.path.dirname(os.path.abspath(out_path_base))
+        extra_pandoc_args.extend(['--resource-path', out_dir])
     # Handle format_smartly header option.
     if (render_options.get(RenderOption.format_smartly)
             and '+smart' not in pandoc_md_extensions):
@@ -443,24 +1008,6 @@ def output_html_document(header, parts, output_fmt_str, global_options,
             logger.info(f'Adding file after body "{after_body}"')
             extra_pandoc_args.extend(['--include-after-body', after_body])
 
-    pandoc_header = header.copy()
-    pandoc_header.pop('output')
-    pandoc_metadata = yaml.dump(
-        pandoc_header,
-        default_flow_style=False,
-        indent=4
-    )
-    md_out_str = f'---\n{pandoc_metadata}\n---\n{md_out_str}'
-
-    if render_options.get(RenderOption.keep_markdown):
-        md_out_path = 'intermediate.md'
-        # if os.path.exists(md_out_path):
-            # raise IOError(f'Target path for intermediate markdown file, "{md_out_path}", already exists')
-            # pass
-        # else:
-        with open(md_out_path, 'w') as md_out_file:
-            md_out_file.write(md_out_str)
-
     # in_fmt = 'markdown_strict' + ''.join(pandoc_md_extensions)
     in_fmt = 'markdown' + ''.join(pandoc_md_extensions)
     out_fmt = 'html'
@@ -468,17 +1015,120 @@ def output_html_document(header, parts, output_fmt_str, global_options,
 
     out_path = f"{out_path_base}{os.extsep}html"
 
-    logger.info('Converting markdown output to HTML...')
-    pypandoc.convert_text(
-        source=md_out_str,
-        to=out_fmt,
-        format=in_fmt,
-        extra_args=extra_pandoc_args,
-        outputfile=out_path,
-    )
-    logger.info('Converted markdown output to HTML.')
+    if render_options.get(RenderOption.keep_markdown):
+        # Keep it in the document's own directory, so that documents rendered
+        # side by side don't overwrite each other's.
+        md_keep_path = os.path.join(get_scratch_dir(out_path_base),
+                                    'intermediate.md')
+    else:
+        md_keep_path = None
+    # Pandoc reads the markdown from a file, so it need not all be in memory.
+    with spool_file(out_path_base, keep_path=md_keep_path) as md_out_path:
+        logger.info('Rendering evaluated document...')
+        with open(md_out_path, 'w', encoding='utf-8') as md_out_file:
+            pandoc_metadata = get_pandoc_metadata(header)
+            md_out_file.write(f'---\n{pandoc_metadata}\n---\n')
+            write_parts(md_out_file, parts_evaled,
+                        render_figure=render_figure,
+                        out_dir=os.path.dirname(
+                            os.path.abspath(out_path_base)))
+        logger.info('Rendered evaluated document.')
+
+        logger.info('Converting markdown output to HTML...')
+        with trace.span('pandoc', 'pandoc', to=out_fmt):
+            import pypandoc
+
+            pypandoc.convert_file(
+                md_out_path,
+                to=out_fmt,
+                format=in_fmt,
+                extra_args=extra_pandoc_args,
+                outputfile=out_path,
+            )
+        logger.info('Converted markdown output to HTML.')
+
+
+# The pandoc writer for each markdown output, and the suffix of its file. The
+# suffixes differ from the plain '.md' of the input, to not overwrite it.
+MARKDOWN_OUTPUT_FORMATS = {
+    OutputFormat.md_document: ('markdown', '.out.md'),
+    OutputFormat.github_markdown_document: ('gfm', '.gfm.md'),
+}
+
+
+def output_markdown_document(header, parts_evaled, output_fmt_str,
+                             out_path_base):
+    render_options = update_render_options(DEFAULT_RENDER_OPTS,
+                                           header['output'][output_fmt_str])
+    pandoc_fmt, out_suffix = MARKDOWN_OUTPUT_FORMATS[
+        OutputFormat(output_fmt_str)
+    ]
+
+    store = get_figure_store(render_options, out_path_base)
+    render_figure = markdown_figure_renderer(store, out_path_base)
+
+    # The rendered markdown is the output, unless it needs a feature that
+    # only pandoc provides.
+    pandoc_args = []
+    if render_options.get(RenderOption.table_of_contents):
+        logger.info('Enabling "table of contents" option')
+        pandoc_args.extend(['--standalone', '--table-of-contents'])
+        toc_depth = render_options.get(RenderOption.table_of_contents_depth)
+        if toc_depth is not None:
+            logger.info(f'Setting table of contents depth to "{toc_depth}"')
+            pandoc_args.extend(['--toc-depth', str(toc_depth)])
+    if render_options.get(RenderOption.number_sections):
+        logger.info('Enabling "number sections" option')
+        pandoc_args.append('--number-sections')
+
+    out_path = f'{out_path_base}{out_suffix}'
+    with ExitStack() as stack:
+        md_out_path = stack.enter_context(spool_file(out_path_base))
+        logger.info('Rendering evaluated document...')
+        with open(md_out_path, 'w', encoding='utf-8') as md_out_file:
+            write_parts(md_out_file, parts_evaled,
+                        render_figure=render_figure,
+                        out_dir=os.path.dirname(
+                            os.path.abspath(out_path_base)))
+        logger.info('Rendered evaluated document.')
+
+        if pandoc_args:
+            converted_path = stack.enter_context(spool_file(out_path_base))
+            logger.info(f'Converting markdown output to "{pandoc_fmt}"...')
+            with trace.span('pandoc', 'pandoc', to=pandoc_fmt):
+                import pypandoc
+
+                pypandoc.convert_file(
+                    md_out_path,
+                    to=pandoc_fmt,
+                    format='markdown' + ''.join(DEFAULT_PANDOC_MD_EXTENSIONS),
+                    extra_args=pandoc_args,
+                    outputfile=converted_path,
+                )
+            logger.info(f'Converted markdown output to "{pandoc_fmt}".')
+            md_out_path = converted_path
+
+        out_part_path = stack.enter_context(
+            spool_file(out_path_base, keep_path=out_path)
+        )
+        with open(out_part_path, 'w', encoding='utf-8') as out_file:
+            if render_options.get(RenderOption.preserve_yaml):
+                pandoc_metadata = get_pandoc_metadata(header)
+                out_file.write(f'---\n{pandoc_metadata}---\n')
+            with open(md_out_path, encoding='utf-8') as md_out_file:
+                shutil.copyfileobj(md_out_file, out_file)
 
 
 FORMAT_TO_ROUTINE = {
     OutputFormat.html_document: output_html_document,
+    OutputFormat.md_document: output_markdown_document,
+    OutputFormat.github_markdown_document: output_markdown_document,
 }
+
+
+def get_output_routine(output_fmt_str):
+    output_fmt = OutputFormat(output_fmt_str)
+    try:
+        return FORMAT_TO_ROUTINE[output_fmt]
+    except KeyError:
+        raise NotImplementedError(f'No routine for output "{output_fmt_str}"')
@@ -0,0 +1,128 @@
+"""Sections of a document that can be evaluated on separate kernels.
+
+Code parts are grouped by the dependencies that `depgraph` finds, which count
+calling a method of a name for its effect as writing the name, so code that
+changes an object in place runs in the section of the code that reads it
+afterwards. Chunks that depend on no other chunk, such as imports, are setup
+chunks: each section that needs one runs it first, rather than the setup
+tying sections together.
+Code that numbers or refers to figures and tables all goes in one section,
+so that the numbers come out as they would in document order.
+"""
+from collections import namedtuple
+
+from . import parseful as parse
+from . import depgraph
+
+# Preamble names whose use depends on the figures and tables registered by
+# earlier code.
+REFERENCE_NAMES = frozenset([
+    'register_fig', 'display_fig', 'fig_ref', 'Fig_ref', 'insert_img',
+    'register_table', 'display_table', 'tbl_ref', 'Tbl_ref',
+])
+
+# The indexes of the parts a section evaluates, in document order, and of
+# those whose results it provides.
+Section = namedtuple('Section', ['run', 'owned'])
+
+
+class _DisjointSets:
+
+    def __init__(self, items):
+        self._parents = {item: item for item in items}
+
+    def find(self, item):
+        while self._parents[item] != item:
+            self._parents[item] = self._parents[self._parents[item]]
+            item = self._parents[item]
+        return item
+
+    def union(self, a, b):
+        a, b = self.find(a), self.find(b)
+        # Keep the earliest part as the representative.
+        self._parents[max(a, b)] = min(a, b)
+
+
+def _reads(code):
+    try:
+        reads, _ = depgraph.names_used(code)
+    except SyntaxError:
+        return None
+    return reads
+
+
+def plan_sections(parts, nodes):
+    """Return the `Section`s of the code parts in `parts`.
+
+    `nodes` are the `depgraph.ChunkNode`s of the document's chunks.
+    """
+    code_indexes = []
+    chunk_part_indexes = []
+    # The chunks each code part depends on directly.
+    upstream = {}
+    uses_references = set()
+    last_writers = {}
+    for i, part in enumerate(parts):
+        if isinstance(part, parse.CodeChunk):
+            chunk_index = len(chunk_part_indexes)
+            chunk_part_indexes.append(i)
+            upstream[i] = set(nodes[chunk_index].upstream)
+            try:
+                reads, writes = depgraph.names_used(part.code)
+            except SyntaxError:
+                reads, writes = None, set()
+            for name in writes:
+                last_writers[name] = chunk_index
+        elif isinstance(part, parse.InlineCode):
+            reads = _reads(part.code)
+            if reads is None:
+                upstream[i] = set(range(len(chunk_part_indexes)))
+            else:
+                upstream[i] = {last_writers[name] for name in reads
+                               if name in last_writers}
+        else:
+            continue
+        code_indexes.append(i)
+        if reads is None or reads & REFERENCE_NAMES:
+            uses_references.add(i)
+
+    setup = {
+        chunk_part_indexes[node.index] for node in nodes
+        if not node.upstream
+        and chunk_part_indexes[node.index] not in uses_references
+    }
+
+    sets = _DisjointSets(code_indexes)
+    for i in code_indexes:
+        for chunk_index in upstream[i]:
+            up_i = chunk_part_indexes[chunk_index]
+            if up_i not in setup:
+                sets.union(i, up_i)
+    for i in uses_references:
+        sets.union(i, min(uses_references))
+
+    # A setup chunk needed by just one section belongs to it.
+    setup_users = {i: set() for i in setup}
+    for i in code_indexes:
+        if i not in setup:
+            for chunk_index in upstream[i]:
+                up_i = chunk_part_indexes[chunk_index]
+                if up_i in setup:
+                    setup_users[up_i].add(sets.find(i))
+    for i, users in setup_users.items():
+        if len(users) == 1:
+            sets.union(i, users.pop())
+
+    members = {}
+    for i in code_indexes:
+        members.setdefault(sets.find(i), []).append(i)
+    sections = []
+    for root in sorted(members):
+        owned = members[root]
+        needed = {
+            chunk_part_indexes[chunk_index]
+            for i in owned for chunk_index in upstream[i]
+        }
+        run = sorted(set(owned) | (needed & setup))
+        sections.append(Section(run=run, owned=owned))
+    return sections
@@ -0,0 +1,121 @@
+"""On-disk cache of parsed documents, for `nestler --parse-cache`.
+
+Entries are addressed by a hash of the document's text and the version of
+nestler, and hold its header and parts, so that an unchanged document is
+loaded without any parsing. Each document file also gets a stamp of its
+modification time and size, keyed on the file's identity, so that a file
+that hasn't been touched is found without even reading and hashing it.
+"""
+import hashlib
+import io
+import json
+import logging
+import os
+import pickle
+
+from . import __version__
+from . import parseful as parse
+from .cache import _write_atomic
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PATH = 'cache/parsed'
+
+# Larger documents are read as they are evaluated, rather than held whole in
+# memory, so aren't cached.
+MAX_DOCUMENT_BYTES = 2 ** 26
+
+PARTS_EXT = 'parts'
+STAMP_EXT = 'stamp'
+
+
+def document_key(s):
+    return hashlib.sha256(f'{__version__}\0{s}'.encode()).hexdigest()
+
+
+def _file_stat(stream):
+    try:
+        return os.fstat(stream.fileno())
+    except (AttributeError, io.UnsupportedOperation, OSError):
+        return None
+
+
+class ParseCache:
+    """A directory of parsed documents."""
+
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = path
+        os.makedirs(self.path, exist_ok=True)
+
+    def _entry_path(self, name, ext):
+        return os.path.join(self.path, f'{name}.{ext}')
+
+    def _stamp_path(self, stat):
+        return self._entry_path(f'{stat.st_dev}-{stat.st_ino}', STAMP_EXT)
+
+    def _read_stamp(self, stat):
+        try:
+            with open(self._stamp_path(stat)) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _write_stamp(self, stat, key):
+        stamp = {'mtime': stat.st_mtime_ns, 'size': stat.st_size, 'key': key}
+        _write_atomic(self._stamp_path(stat), json.dumps(stamp).encode(),
+                      compress=False)
+
+    def get(self, key):
+        try:
+            with open(self._entry_path(key, PARTS_EXT), 'rb') as f:
+                return pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception:
+            logger.warning(f'Ignoring unreadable parse cache entry "{key}"')
+            return None
+
+    def put(self, key, parsed):
+        _write_atomic(self._entry_path(key, PARTS_EXT),
+                      pickle.dumps(parsed, pickle.HIGHEST_PROTOCOL),
+                      compress=False)
+
+    def _remove(self, key):
+        try:
+            os.remove(self._entry_path(key, PARTS_EXT))
+        except FileNotFoundError:
+            pass
+
+    def parse_stream(self, stream):
+        """Return the header and parts of a document read from a stream.
+
+        The parts are a list if they come from, or were added to, the cache.
+        Otherwise, as for `parseful.parse_stream`, they are an iterator that
+        reads the stream as it goes.
+        """
+        stat = _file_stat(stream)
+        if stat is None or stat.st_size > MAX_DOCUMENT_BYTES:
+            return parse.parse_stream(stream)
+
+        stamp = self._read_stamp(stat)
+        if (stamp is not None and stamp['mtime'] == stat.st_mtime_ns
+                and stamp['size'] == stat.st_size):
+            parsed = self.get(stamp['key'])
+            if parsed is not None:
+                logger.info('Parse cache hit, document file is unchanged.')
+                return parsed
+
+        s = stream.read()
+        key = document_key(s)
+        parsed = self.get(key)
+        if parsed is None:
+            logger.info('Parse cache miss, parsing document.')
+            parsed = parse.parse(s)
+            self.put(key, parsed)
+        else:
+            logger.info('Parse cache hit, document text is unchanged.')
+        if stamp is not None and stamp['key'] != key:
+            # The file's last version is probably not coming back.
+            self._remove(stamp['key'])
+        self._write_stamp(stat, key)
+        return parsed
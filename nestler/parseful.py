@@ -1,9 +1,7 @@
 import re
 from decimal import Decimal
 from collections import namedtuple, OrderedDict
-
-import yaml
-import pyparsing as pp
+from functools import lru_cache
 
 CODE_PREFIX_STR = 'python'
 
@@ -15,29 +13,6 @@ ChunkAssignOpt = namedtuple('ChunkAssignOpt', ['identifier', 'value'])
 CodeChunk = namedtuple('CodeChunk', ['code', 'options'])
 InlineCode = namedtuple('InlineCode', ['code'])
 
-# Python-style identifier, but with optional dot separators in rest for cases
-# like `fig.cap = "..."`
-identifier = (pp.Word(initChars=pp.alphas+"_", bodyChars=pp.alphanums+"_.")
-              .setParseAction(lambda t: Identifier(name=t[0])))
-
-# Define a few characters involved in rules.
-L_BRACE, R_BRACE, EQUALS = map(pp.Suppress, '{}=')
-CODE_PREFIX = pp.Suppress(pp.Literal(CODE_PREFIX_STR))
-
-number_literal = (
-    pp.Combine(
-        pp.Word("+-" + pp.nums, pp.nums)
-        + pp.Optional(pp.Literal(".") + pp.Optional(pp.Word(pp.nums)))
-    ).setParseAction(lambda t: Decimal(t[0]))
-)
-
-string_literal = (pp.quotedString
-                  .setParseAction(lambda t: StringLit(contents=t[0][1:-1])))
-
-WHITE_CHARS = ' \t\r\n'
-whitespace = pp.Suppress(pp.White(ws=WHITE_CHARS))
-maybe_whitespace = pp.Suppress(pp.Optional(pp.White(ws=WHITE_CHARS)))
-
 
 def process_chunk_opts(t):
     r = OrderedDict()
@@ -54,40 +29,77 @@ def process_chunk_opts(t):
     return r
 
 
-# Identifier is just there because values can be set to FALSE, like it's an
-# identifier. Maybe it is, I don't know how R works.
-option_val = identifier | string_literal | number_literal
-chunk_assign_option = (
-    identifier + maybe_whitespace + EQUALS + maybe_whitespace + option_val
-).setParseAction(lambda t: ChunkAssignOpt(identifier=t[0], value=t[1]))
-chunk_options = (
-    whitespace
-    + pp.delimitedList(chunk_assign_option | identifier | string_literal,
-                       delim=',')
-).setParseAction(process_chunk_opts)
-chunk_header = (
-    L_BRACE + CODE_PREFIX
-    # + pp.Optional(chunk_label, default=None)
-    + pp.Optional(chunk_options, default={})
-    + maybe_whitespace + R_BRACE
-)
-VALID_CODE_CHARS = (pp.printables + '\n\r\t ')
-code_body = pp.Word(VALID_CODE_CHARS).setParseAction(lambda t: t[0])
+# The chunk and inline code grammars.
+Grammar = namedtuple('Grammar', ['chunk', 'inline_code'])
 
-chunk = (
-    chunk_header + code_body
-).setParseAction(lambda t: CodeChunk(options=t[0], code=t[1]))
+WHITE_CHARS = ' \t\r\n'
 
-inline_code = (
-    CODE_PREFIX + whitespace + code_body
-).setParseAction(lambda t: InlineCode(code=t[0]))
 
-VALID_TEXT_CHARS = (pp.printables + '\n\r\t ')
+@lru_cache(maxsize=None)
+def get_grammar():
+    # Built when first needed, as importing pyparsing and building the
+    # grammar take a while, and parsed documents may come from the cache.
+    import pyparsing as pp
+
+    # Python-style identifier, but with optional dot separators in rest for
+    # cases like `fig.cap = "..."`
+    identifier = (pp.Word(initChars=pp.alphas+"_",
+                          bodyChars=pp.alphanums+"_.")
+                  .setParseAction(lambda t: Identifier(name=t[0])))
+
+    # Define a few characters involved in rules.
+    L_BRACE, R_BRACE, EQUALS = map(pp.Suppress, '{}=')
+    CODE_PREFIX = pp.Suppress(pp.Literal(CODE_PREFIX_STR))
+
+    number_literal = (
+        pp.Combine(
+            pp.Word("+-" + pp.nums, pp.nums)
+            + pp.Optional(pp.Literal(".") + pp.Optional(pp.Word(pp.nums)))
+        ).setParseAction(lambda t: Decimal(t[0]))
+    )
+
+    string_literal = (pp.quotedString.setParseAction(
+        lambda t: StringLit(contents=t[0][1:-1])))
+
+    whitespace = pp.Suppress(pp.White(ws=WHITE_CHARS))
+    maybe_whitespace = pp.Suppress(pp.Optional(pp.White(ws=WHITE_CHARS)))
+
+    # Identifier is just there because values can be set to FALSE, like it's
+    # an identifier. Maybe it is, I don't know how R works.
+    option_val = identifier | string_literal | number_literal
+    chunk_assign_option = (
+        identifier + maybe_whitespace + EQUALS + maybe_whitespace + option_val
+    ).setParseAction(lambda t: ChunkAssignOpt(identifier=t[0], value=t[1]))
+    chunk_options = (
+        whitespace
+        + pp.delimitedList(chunk_assign_option | identifier | string_literal,
+                           delim=',')
+    ).setParseAction(process_chunk_opts)
+    chunk_header = (
+        L_BRACE + CODE_PREFIX
+        # + pp.Optional(chunk_label, default=None)
+        + pp.Optional(chunk_options, default={})
+        + maybe_whitespace + R_BRACE
+    )
+    VALID_CODE_CHARS = (pp.printables + '\n\r\t ')
+    code_body = pp.Word(VALID_CODE_CHARS).setParseAction(lambda t: t[0])
+
+    chunk = (
+        chunk_header + code_body
+    ).setParseAction(lambda t: CodeChunk(options=t[0], code=t[1]))
+
+    inline_code = (
+        CODE_PREFIX + whitespace + code_body
+    ).setParseAction(lambda t: InlineCode(code=t[0]))
+
+    return Grammar(chunk=chunk, inline_code=inline_code)
 
 
 def read_maybe_yaml_block(source):
     match = re.match(r'^---\n([\s\S]+?)\n---', source)
     if match is not None:
+        import yaml
+
         yaml_source = match.group(1)
         contents = yaml.safe_load(yaml_source)
         remainder = source[match.end():]
@@ -105,47 +117,191 @@ INLINE_PARSE_START = f'{INLINE_PREFIX}{CODE_PREFIX_STR} '
 INLINE_PARSE_END = '`'
 
 
-def _parse(s):
-    header, s = read_maybe_yaml_block(s)
+# Matches the start of either a code chunk or an inline code span. The two
+# can't match at the same position, so the earliest match is the next part.
+PART_START_RE = re.compile(
+    f'{re.escape(CHUNK_PARSE_START)}|{re.escape(INLINE_PARSE_START)}'
+)
+
+
+def _find_end(s, end_str, start, kind):
+    end = s.find(end_str, start)
+    if end < 0:
+        import pyparsing as pp
+
+        raise pp.ParseFatalException(s, start, f'Unterminated {kind}')
+    return end
+
 
+def scan(s):
+    """Yield the text, `CodeChunk` and `InlineCode` parts of a document body.
+
+    Text between code parts is yielded as a single string, and never as an
+    empty one.
+    """
+    grammar = None
     i = 0
-    parts = []
-    while i < len(s):
-        if s[i:].startswith(CHUNK_PARSE_START):
-            i += len(CHUNK_PREFIX)
-            chunk_str = ''
-            while not s[i:].startswith(CHUNK_PARSE_END):
-                chunk_str += s[i]
-                i += 1
-            i += len(CHUNK_PARSE_END)
-            chunk_obj = chunk.parseString(chunk_str, parseAll=True)
-            parts.extend(chunk_obj)
-        elif s[i:].startswith(INLINE_PARSE_START):
-            i += len(INLINE_PREFIX)
-            inline_code_str = ''
-            while not s[i:].startswith(INLINE_PARSE_END):
-                inline_code_str += s[i]
-                i += 1
-            i += len(INLINE_PARSE_END)
-            inline_code_obj = inline_code.parseString(inline_code_str,
-                                                      parseAll=True)
-            parts.extend(inline_code_obj)
+    while True:
+        match = PART_START_RE.search(s, i)
+        if match is None:
+            break
+        start = match.start()
+        if start > i:
+            yield s[i:start]
+        if grammar is None:
+            grammar = get_grammar()
+        if match.group() == CHUNK_PARSE_START:
+            i = start + len(CHUNK_PREFIX)
+            end = _find_end(s, CHUNK_PARSE_END, i, 'code chunk')
+            yield from grammar.chunk.parseString(s[i:end], parseAll=True)
+            i = end + len(CHUNK_PARSE_END)
+        else:
+            i = start + len(INLINE_PREFIX)
+            end = _find_end(s, INLINE_PARSE_END, i, 'inline code')
+            yield from grammar.inline_code.parseString(s[i:end],
+                                                       parseAll=True)
+            i = end + len(INLINE_PARSE_END)
+    if i < len(s):
+        yield s[i:]
+
+
+# How much of a stream to read at a time.
+BLOCK_SIZE = 2 ** 20
+
+YAML_BLOCK_START = '---\n'
+YAML_BLOCK_END = '\n---'
+
+
+def read_stream_header(stream, block_size=BLOCK_SIZE):
+    """Read the YAML header of a document from a stream, if it has one.
+
+    Return the header, and what was read of the rest of the document.
+    """
+    buf = stream.read(block_size)
+    if not YAML_BLOCK_START.startswith(buf[:len(YAML_BLOCK_START)]):
+        return {}, buf
+    while len(buf) < len(YAML_BLOCK_START):
+        block = stream.read(block_size)
+        if not block:
+            return {}, buf
+        buf += block
+    if not buf.startswith(YAML_BLOCK_START):
+        return {}, buf
+    # The header holds at least one character.
+    search_start = len(YAML_BLOCK_START) + 1
+    while True:
+        end = buf.find(YAML_BLOCK_END, search_start)
+        if end >= 0:
+            break
+        search_start = max(search_start, len(buf) - len(YAML_BLOCK_END) + 1)
+        block = stream.read(block_size)
+        if not block:
+            return {}, buf
+        buf += block
+    import yaml
+
+    contents = yaml.safe_load(buf[len(YAML_BLOCK_START):end])
+    return contents, buf[end + len(YAML_BLOCK_END):]
+
+
+# The most of the end of the text read so far that could be the start of a
+# code part, so that it can't be yielded as text yet.
+MAX_PART_START_LEN = max(len(CHUNK_PARSE_START), len(INLINE_PARSE_START)) - 1
+
+
+def scan_stream(stream, buf='', block_size=BLOCK_SIZE):
+    """Yield the parts of a document body read from a stream, as `scan` does.
+
+    The stream is read a block at a time, so the memory used depends on the
+    largest code part, not the document. Long text between code parts may be
+    yielded as several strings. `buf` is text already read from the stream.
+    """
+    eof = False
+    while True:
+        match = PART_START_RE.search(buf)
+        if match is None:
+            if eof:
+                break
+            keep = min(len(buf), MAX_PART_START_LEN)
+            if len(buf) > keep:
+                yield buf[:len(buf) - keep]
+                buf = buf[len(buf) - keep:]
+            block = stream.read(block_size)
+            eof = not block
+            buf += block
+            continue
+        start = match.start()
+        if start > 0:
+            yield buf[:start]
+        if match.group() == CHUNK_PARSE_START:
+            prefix, end_str, kind = CHUNK_PREFIX, CHUNK_PARSE_END, 'code chunk'
+            grammar = get_grammar().chunk
         else:
-            c = s[i]
-            if (len(parts) == 0) or (not isinstance(parts[-1], str)):
-                parts.append(c)
-            else:
-                parts[-1] += c
-            i += 1
+            prefix, end_str, kind = (
+                INLINE_PREFIX, INLINE_PARSE_END, 'inline code',
+            )
+            grammar = get_grammar().inline_code
+        buf = buf[start + len(prefix):]
+        search_start = 0
+        while True:
+            end = buf.find(end_str, search_start)
+            if end >= 0:
+                break
+            block = stream.read(block_size)
+            if not block:
+                import pyparsing as pp
+
+                raise pp.ParseFatalException(buf, 0, f'Unterminated {kind}')
+            search_start = max(0, len(buf) - len(end_str) + 1)
+            buf += block
+        yield from grammar.parseString(buf[:end], parseAll=True)
+        buf = buf[end + len(end_str):]
+    if buf:
+        yield buf
+
+
+def _print_parse_error(e):
+    print("Error:" + e.msg)
+    print(e.markInputline('^'))
+
+
+def _is_parse_error(e):
+    import pyparsing as pp
+
+    return isinstance(e, (pp.ParseFatalException, pp.ParseException))
+
+
+def _report_stream_errors(parts):
+    try:
+        yield from parts
+    except Exception as e:
+        if not _is_parse_error(e):
+            raise
+        _print_parse_error(e)
+        raise
+
+
+def parse_stream(stream, block_size=BLOCK_SIZE):
+    """Return the header of a document read from a stream, and an iterator
+    over its parts, which reads the rest of the stream as it goes."""
+    header, buf = read_stream_header(stream, block_size=block_size)
+    parts = scan_stream(stream, buf=buf, block_size=block_size)
+    return header, _report_stream_errors(parts)
+
+
+def _parse(s):
+    header, s = read_maybe_yaml_block(s)
+    parts = list(scan(s))
     return header, parts
 
 
 def parse(s):
     try:
         return _parse(s)
-    except (pp.ParseFatalException, pp.ParseException) as e:
-        print("Error:" + e.msg)
-        print(e.markInputline('^'))
+    except Exception as e:
+        if not _is_parse_error(e):
+            raise
+        _print_parse_error(e)
         raise
 
 
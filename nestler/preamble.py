@@ -58,6 +58,15 @@ def register_fig(slug, caption=None, up=True, noun=_DEFAULT_FIGURE_NOUN):
 
 def display_fig(fig, slug, caption):
     register_fig(slug, caption=caption)
+    try:
+        from matplotlib.figure import Figure
+    except ImportError:
+        pass
+    else:
+        if isinstance(fig, Figure):
+            # Use the chunk's figure options.
+            from .backend_inline import publish_figure
+            return publish_figure(fig)
     return display(fig)
 
 
@@ -79,7 +88,169 @@ def register_table(slug):
     PREAMBLE_VARS['registered_tables'].append(slug)
 
 
-def display_table(df, slug, caption=None, up=True):
+_DEFAULT_TABLE_PAGE_SIZE = 25
+
+# Draws the pages of a paged table, from the data in the script element
+# before it.
+_PAGED_TABLE_SCRIPT = """\
+(function () {
+  var root = document.currentScript.parentNode;
+  var table = JSON.parse(
+    root.querySelector('script[type="application/json"]').textContent);
+  var pageSize = Number(root.dataset.pageSize);
+  var nRows = Number(root.dataset.nRows);
+  var head = root.querySelector('thead');
+  var body = root.querySelector('tbody');
+  var pager = root.querySelector('.nestler-table-pager');
+  var page = 0;
+  function row(tag, values) {
+    var tr = document.createElement('tr');
+    values.forEach(function (value) {
+      var cell = document.createElement(tag);
+      cell.textContent = value === null ? '' : value;
+      tr.appendChild(cell);
+    });
+    return tr;
+  }
+  head.appendChild(row('th', [''].concat(table.columns)));
+  function show() {
+    var start = page * pageSize;
+    var end = Math.min(start + pageSize, table.data.length);
+    body.textContent = '';
+    for (var i = start; i < end; i++) {
+      body.appendChild(row('td', [table.index[i]].concat(table.data[i])));
+    }
+    pager.textContent = 'Rows ' + (start + 1) + '-' + end + ' of ' + nRows
+      + ' ';
+    [['Previous', -1, page > 0], ['Next', 1, end < table.data.length]]
+      .forEach(function (button) {
+        var el = document.createElement('button');
+        el.textContent = button[0];
+        el.disabled = !button[2];
+        el.onclick = function () { page += button[1]; show(); };
+        pager.appendChild(el);
+      });
+  }
+  show();
+})();"""
+
+
+def _table_option(value, name):
+    # An argument to `display_table`, or else the chunk's option.
+    if value is not None:
+        return value
+    return (PREAMBLE_VARS.get('figure_options') or {}).get(f'table_{name}')
+
+
+def _caption_html(caption_txt):
+    import html
+    return (f'<caption style="caption-side: bottom">'
+            f'{html.escape(caption_txt)}</caption>')
+
+
+def _left_out(n, limit):
+    # The start and end of the middle of `n` rows or columns to leave out to
+    # show at most `limit`, or None.
+    if limit is None or n <= limit:
+        return None
+    n_head = (limit + 1) // 2
+    return n_head, n - (limit - n_head)
+
+
+def _styled_table_html(styler, caption_txt, max_rows, max_cols):
+    import copy
+    import html
+    import re
+
+    # Styler's own limits keep just the first rows and columns, so hide the
+    # middle ones instead. Styles are still worked out from the whole table.
+    styler = copy.copy(styler)
+    row_gap = _left_out(len(styler.data.index), max_rows)
+    col_gap = _left_out(len(styler.data.columns), max_cols)
+    if row_gap is not None:
+        styler.hide(styler.data.index[slice(*row_gap)], axis='index')
+    if col_gap is not None:
+        styler.hide(styler.data.columns[slice(*col_gap)], axis='columns')
+    table_html = (
+        styler
+        .set_caption(html.escape(caption_txt))
+        .set_table_styles([
+            {'selector': 'caption', 'props': [('caption-side', 'bottom')]},
+        ], overwrite=False)
+        .set_table_attributes('class="table"')
+        .to_html()
+    )
+
+    # Mark where columns and rows were left out.
+    if col_gap is not None:
+        table_html = re.sub(
+            rf'<(t[hd]) [^>]*class="[^"]*\bcol{col_gap[1]}\b',
+            lambda match: f'<{match[1]}>...</{match[1]}>{match[0]}',
+            table_html,
+        )
+    if row_gap is not None:
+        body_start = table_html.index('<tbody>') + len('<tbody>')
+        first_row = table_html[body_start:table_html.index('</tr>',
+                                                           body_start)]
+        gap_row = '<tr>{}{}</tr>'.format(
+            '<th>...</th>' * first_row.count('<th'),
+            '<td>...</td>' * first_row.count('<td'),
+        )
+        row_end = body_start
+        for _ in range(row_gap[0]):
+            row_end = table_html.index('</tr>', row_end) + len('</tr>')
+        table_html = table_html[:row_end] + gap_row + table_html[row_end:]
+    return table_html
+
+
+def _plain_table_html(df, caption_txt, max_rows, max_cols):
+    html = df.to_html(max_rows=max_rows, max_cols=max_cols, border=0,
+                      classes='table')
+    # Pandas can't add a caption, so put it just inside the table tag.
+    start = html.index('>') + 1
+    return html[:start] + _caption_html(caption_txt) + html[start:]
+
+
+def _paged_table_html(df, caption_txt, max_rows, max_cols, page_size):
+    n_rows = len(df)
+    col_gap = _left_out(len(df.columns), max_cols)
+    if col_gap is not None:
+        start, end = col_gap
+        df = df.iloc[:, list(range(start))
+                     + list(range(end, len(df.columns)))].copy()
+        df.insert(start, '...', '...', allow_duplicates=True)
+    if max_rows is not None:
+        df = df.iloc[:max_rows]
+    data = df.to_json(orient='split', date_format='iso', default_handler=str)
+    # Keep the data from closing its script element.
+    data = data.replace('</', '<\\/')
+    return (
+        f'<div class="nestler-paged-table" data-page-size="{page_size}" '
+        f'data-n-rows="{n_rows}">'
+        f'<table class="table">{_caption_html(caption_txt)}'
+        '<thead></thead><tbody></tbody></table>'
+        '<div class="nestler-table-pager"></div>'
+        f'<script type="application/json">{data}</script>'
+        f'<script>\n{_PAGED_TABLE_SCRIPT}\n</script>'
+        '</div>'
+    )
+
+
+def display_table(df, slug, caption=None, up=True, max_rows=None,
+                  max_cols=None, fmt=None,
+                  page_size=_DEFAULT_TABLE_PAGE_SIZE):
+    """Display a DataFrame, or a Styler of one, as a numbered table.
+
+    `max_rows`, `max_cols` and `fmt` default to the chunk's tbl.max_rows,
+    tbl.max_cols and tbl.format options. Beyond the limits, the rows and
+    columns in the middle are left out, except that a paged table has its
+    first `max_rows` rows, `page_size` to a page.
+    """
+    import pandas as pd
+    from pandas.io.formats.style import Styler
+
+    if isinstance(df, pd.Series):
+        df = df.to_frame()
     register_table(slug)
 
     ref = tbl_ref(slug, up=up)
@@ -87,22 +258,28 @@ def display_table(df, slug, caption=None, up=True):
     if caption is not None:
         caption_txt += f': {caption}'
 
-    return display(
-        df
-        .style
-        .set_caption(caption_txt)
-        .set_table_styles([
-            {'selector': 'caption', 'props': [('caption-side', 'bottom')]},
-        ])
-        .set_table_attributes('class="table"')
-    )
-
-try:
-    import matplotlib
-except ImportError:
-    pass
-else:
-    matplotlib.use(_DEFAULT_MPL_BACKEND)
+    max_rows = _table_option(max_rows, 'max_rows')
+    max_cols = _table_option(max_cols, 'max_cols')
+    fmt = _table_option(fmt, 'format') or 'auto'
+    is_styler = isinstance(df, Styler)
+    if fmt == 'auto':
+        # Styling renders each cell through a template, so is only worth it
+        # for tables that were styled.
+        fmt = 'styled' if is_styler else 'plain'
+    if fmt == 'styled':
+        html = _styled_table_html(df if is_styler else df.style,
+                                  caption_txt, max_rows, max_cols)
+    else:
+        if is_styler:
+            df = df.data
+        if fmt == 'plain':
+            html = _plain_table_html(df, caption_txt, max_rows, max_cols)
+        elif fmt == 'paged':
+            html = _paged_table_html(df, caption_txt, max_rows, max_cols,
+                                     page_size)
+        else:
+            raise ValueError(f'Unknown table format "{fmt}"')
+    publish_display_data({'text/html': html})
 
 
 # Images
@@ -110,3 +287,82 @@ else:
 def insert_img(img, slug, caption, noun=_DEFAULT_FIGURE_NOUN):
     caption_txt, _ = register_fig(slug, caption)
     print(f'\n![{caption_txt}]({img} "{caption_txt}")')
+
+
+# Kernel pools.
+
+def _reset():
+    # Clear the namespace for the next document, and put the preamble back.
+    import sys
+    from IPython import get_ipython
+    ip = get_ipython()
+    ip.reset(new_session=False)
+    for register in ('registered_figures', 'registered_tables'):
+        PREAMBLE_VARS[register].clear()
+    if 'matplotlib.pyplot' in sys.modules:
+        sys.modules['matplotlib.pyplot'].close('all')
+    _push_preamble(ip)
+
+
+def _memory_bytes():
+    # Resident set size, on Linux.
+    import os
+    with open('/proc/self/statm') as f:
+        rss_pages = int(f.read().split()[1])
+    return rss_pages * os.sysconf('SC_PAGE_SIZE')
+
+
+# Loading as an IPython extension.
+
+class _MatplotlibBackendHook:
+    """Switch matplotlib to our backend once user code imports it.
+
+    Importing matplotlib takes a while, so documents that don't plot
+    shouldn't pay for it.
+    """
+
+    def find_spec(self, fullname, path, target=None):
+        if fullname != 'matplotlib':
+            return None
+        import sys
+        import importlib.util
+        # Only the first import needs the backend set, and this lets the
+        # other finders find matplotlib.
+        sys.meta_path.remove(self)
+        spec = importlib.util.find_spec(fullname)
+        if spec is None or spec.loader is None:
+            return spec
+        exec_module = spec.loader.exec_module
+
+        def exec_and_use_backend(module):
+            exec_module(module)
+            module.use(_DEFAULT_MPL_BACKEND)
+        spec.loader.exec_module = exec_and_use_backend
+        return spec
+
+
+def _install_matplotlib_hook():
+    import sys
+    if 'matplotlib' in sys.modules:
+        sys.modules['matplotlib'].use(_DEFAULT_MPL_BACKEND)
+    elif not any(isinstance(finder, _MatplotlibBackendHook)
+                 for finder in sys.meta_path):
+        sys.meta_path.insert(0, _MatplotlibBackendHook())
+
+
+def _push_preamble(ip):
+    # As `from nestler.preamble import *` would, but hidden from the user's
+    # variables, such as those that `%who` lists and that snapshots save.
+    import types
+    names = {
+        name: value for name, value in globals().items()
+        if not name.startswith('_')
+        and not isinstance(value, types.ModuleType)
+        and name != 'load_ipython_extension'
+    }
+    ip.push(names, interactive=False)
+
+
+def load_ipython_extension(ip):
+    _install_matplotlib_hook()
+    _push_preamble(ip)
@@ -0,0 +1,361 @@
+"""A server that renders documents sent to it, for `nestler serve`.
+
+Keeping one process saves each render the cost of starting Python, importing
+nestler and booting a kernel. Jobs are posted as JSON to `/render`, over HTTP
+on localhost or on a Unix socket:
+
+    {"source": "<document text>", "out": "<optional output path base>",
+     "options": {"incremental": true, ...}}
+
+Without `out`, the rendered documents are returned in the response, rather
+than written out. With it, the output path must be inside the server's output
+root. Jobs wait in a bounded queue for one of a fixed number of kernels, and
+each may run for a limited time.
+
+Jobs run arbitrary code, so the server only takes JSON requests, which web
+pages can't send to it without its say-so, addressed to the host it listens
+on, and with a token if it was started with one.
+"""
+import argparse
+import base64
+import hmac
+import io
+import json
+import logging
+import os
+import queue
+import signal
+import socketserver
+import tempfile
+import threading
+from collections import namedtuple
+from concurrent.futures import Future
+from email.message import Message
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from . import execute
+from .kernel_pool import KernelPool
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+DEFAULT_CONCURRENCY = 1
+DEFAULT_QUEUE_SIZE = 16
+DEFAULT_TIMEOUT = 300
+
+# Names for the local host, which HTTP clients may send in the Host header
+# besides the address the server listens on.
+LOCAL_HOSTS = frozenset(['localhost', '127.0.0.1', '::1'])
+
+TOKEN_ENV_VAR = 'NESTLER_SERVE_TOKEN'
+
+# The arguments of `nestler.run` that a job may set.
+JOB_OPTIONS = frozenset([
+    'incremental', 'cache_compress', 'max_output_lines', 'max_output_bytes',
+])
+
+# The name of a document rendered to return in the response.
+INLINE_NAME = 'document'
+
+Job = namedtuple('Job', ['source', 'out_path_base', 'options', 'timeout',
+                         'future'])
+
+
+class JobError(Exception):
+    """A job that the server won't take, with the HTTP status to say so."""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def _host_name(host):
+    # The host of a Host header, without the port.
+    if host.startswith('['):
+        return host[1:].partition(']')[0]
+    return host.rpartition(':')[0] if host.count(':') == 1 else host
+
+
+def _read_outputs(out_dir):
+    outputs = {}
+    for entry in os.scandir(out_dir):
+        if not entry.is_file() or not entry.name.startswith(INLINE_NAME):
+            continue
+        with open(entry.path, 'rb') as f:
+            data = f.read()
+        suffix = entry.name[len(INLINE_NAME):]
+        try:
+            outputs[suffix] = {'encoding': 'utf-8',
+                               'content': data.decode('utf-8')}
+        except UnicodeDecodeError:
+            # Such as PDF or Word documents.
+            outputs[suffix] = {'encoding': 'base64',
+                               'content': base64.b64encode(data).decode()}
+    return outputs
+
+
+class RenderService:
+    """Runs jobs on `concurrency` pool kernels, queueing up to `queue_size`
+    more."""
+
+    def __init__(self, concurrency=DEFAULT_CONCURRENCY,
+                 queue_size=DEFAULT_QUEUE_SIZE, timeout=DEFAULT_TIMEOUT,
+                 max_uses=None, max_memory_bytes=None, out_root=None):
+        self.timeout = timeout
+        # The directory that jobs may write their output in.
+        self.out_root = os.path.realpath(out_root or os.getcwd())
+        self._jobs = queue.Queue(maxsize=queue_size)
+        self._pool = KernelPool(concurrency, max_uses=max_uses,
+                                max_memory_bytes=max_memory_bytes)
+        self._workers = [
+            threading.Thread(target=self._work, name=f'nestler-worker-{i}',
+                             daemon=True)
+            for i in range(concurrency)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def _resolve_out(self, out_path_base):
+        # Relative paths are relative to the output root.
+        path = os.path.realpath(os.path.join(self.out_root, out_path_base))
+        if os.path.commonpath([path, self.out_root]) != self.out_root:
+            raise JobError(HTTPStatus.FORBIDDEN,
+                           f'Output path "{out_path_base}" is outside the '
+                           f'output root')
+        return path
+
+    def submit(self, source, out_path_base=None, options=None, timeout=None):
+        """Queue a job, and return a future of its result."""
+        options = options or {}
+        if out_path_base is not None:
+            out_path_base = self._resolve_out(out_path_base)
+        unknown = set(options) - JOB_OPTIONS
+        if unknown:
+            raise JobError(HTTPStatus.BAD_REQUEST,
+                           f'Unknown options: {", ".join(sorted(unknown))}')
+        if timeout is None or timeout > self.timeout:
+            timeout = self.timeout
+        job = Job(source=source, out_path_base=out_path_base, options=options,
+                  timeout=timeout, future=Future())
+        try:
+            self._jobs.put_nowait(job)
+        except queue.Full:
+            raise JobError(HTTPStatus.SERVICE_UNAVAILABLE,
+                           'Too many jobs queued, try again later.')
+        return job.future
+
+    def _work(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                break
+            if not job.future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = self._render(job)
+            except BaseException as e:
+                job.future.set_exception(e)
+            else:
+                job.future.set_result(result)
+
+    def _render(self, job):
+        # Avoid a circular import.
+        from .nestler import run
+
+        with execute.time_limit(job.timeout):
+            if job.out_path_base is not None:
+                run(io.StringIO(job.source), job.out_path_base,
+                    kernel_pool=self._pool, **job.options)
+                return {'out': job.out_path_base}
+            with tempfile.TemporaryDirectory() as out_dir:
+                run(io.StringIO(job.source),
+                    os.path.join(out_dir, INLINE_NAME),
+                    kernel_pool=self._pool, **job.options)
+                return {'outputs': _read_outputs(out_dir)}
+
+    def status(self):
+        return {'queued': self._jobs.qsize(),
+                'workers': len(self._workers)}
+
+    def shutdown(self):
+        for _ in self._workers:
+            self._jobs.put(None)
+        for worker in self._workers:
+            worker.join()
+        self._pool.shutdown()
+
+
+class RenderHandler(BaseHTTPRequestHandler):
+
+    def _respond(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        if status == HTTPStatus.SERVICE_UNAVAILABLE:
+            self.send_header('Retry-After', '1')
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _check_request(self):
+        # Clients on a Unix socket are trusted by the socket's permissions.
+        if self.client_address:
+            host = _host_name(self.headers.get('Host', ''))
+            if host not in self.server.allowed_hosts:
+                raise JobError(HTTPStatus.FORBIDDEN,
+                               f'Unexpected host "{host}"')
+        token = self.server.token
+        if token is not None:
+            given = self.headers.get('Authorization', '')
+            if not hmac.compare_digest(given.encode(),
+                                       f'Bearer {token}'.encode()):
+                raise JobError(HTTPStatus.UNAUTHORIZED, 'Bad token')
+
+    def _read_job(self):
+        # Pages can post forms and text anywhere without asking, but not
+        # JSON.
+        content_type = Message()
+        content_type['Content-Type'] = self.headers.get('Content-Type', '')
+        if content_type.get_content_type() != 'application/json':
+            raise JobError(HTTPStatus.UNSUPPORTED_MEDIA_TYPE,
+                           'Jobs must be sent as application/json')
+        length = int(self.headers.get('Content-Length', 0))
+        try:
+            job = json.loads(self.rfile.read(length))
+            if not isinstance(job, dict):
+                raise TypeError('not a JSON object')
+            if not isinstance(job['source'], str):
+                raise TypeError('"source" is not a string')
+            return (job['source'], job.get('out'), job.get('options'),
+                    job.get('timeout'))
+        except (ValueError, KeyError, TypeError) as e:
+            raise JobError(HTTPStatus.BAD_REQUEST, f'Bad job: {e}')
+
+    def do_GET(self):
+        try:
+            self._check_request()
+        except JobError as e:
+            self._respond(e.status, {'error': str(e)})
+            return
+        if self.path == '/status':
+            self._respond(HTTPStatus.OK, self.server.service.status())
+        else:
+            self._respond(HTTPStatus.NOT_FOUND, {'error': 'Not found'})
+
+    def do_POST(self):
+        if self.path != '/render':
+            self._respond(HTTPStatus.NOT_FOUND, {'error': 'Not found'})
+            return
+        try:
+            self._check_request()
+            source, out_path_base, options, timeout = self._read_job()
+            future = self.server.service.submit(
+                source, out_path_base=out_path_base, options=options,
+                timeout=timeout,
+            )
+        except JobError as e:
+            self._respond(e.status, {'error': str(e)})
+            return
+        try:
+            result = future.result()
+        except TimeoutError as e:
+            self._respond(HTTPStatus.GATEWAY_TIMEOUT,
+                          {'error': f'{type(e).__name__}: {e}'})
+        except Exception as e:
+            logger.exception('Render failed')
+            self._respond(HTTPStatus.UNPROCESSABLE_ENTITY,
+                          {'error': f'{type(e).__name__}: {e}'})
+        else:
+            self._respond(HTTPStatus.OK, result)
+
+    def address_string(self):
+        # Clients on a Unix socket have no address.
+        return self.client_address[0] if self.client_address else 'local'
+
+    def log_message(self, format, *args):
+        logger.info(f'{self.address_string()}: {format % args}')
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn,
+                     socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(service, socket_path=None, host=DEFAULT_HOST,
+                port=DEFAULT_PORT, token=None):
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = UnixHTTPServer(socket_path, RenderHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), RenderHandler)
+    server.service = service
+    server.allowed_hosts = LOCAL_HOSTS | {host}
+    server.token = token
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='nestler serve',
+                                     description=__doc__.split('\n')[0])
+    parser.add_argument('--socket', metavar='PATH',
+                        help='Listen on a Unix socket at this path, rather '
+                             'than on a TCP port.')
+    parser.add_argument('--host', default=DEFAULT_HOST,
+                        help='Address to listen on.')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT,
+                        help='Port to listen on.')
+    parser.add_argument('-c', '--concurrency', type=int,
+                        default=DEFAULT_CONCURRENCY,
+                        help='Number of jobs to run at once, each on its own '
+                             'kernel.')
+    parser.add_argument('--queue-size', type=int, default=DEFAULT_QUEUE_SIZE,
+                        help='Number of jobs that may wait for a kernel. '
+                             'Jobs beyond this are refused.')
+    parser.add_argument('--timeout', type=float, default=DEFAULT_TIMEOUT,
+                        help='Most seconds a job\'s code may run for, once '
+                             'it has a kernel. A job may ask for less.')
+    parser.add_argument('--max-uses', type=int,
+                        help='Replace each kernel after this many jobs.')
+    parser.add_argument('--out-root', metavar='DIR',
+                        help='Directory that jobs may write output in. '
+                             'Defaults to the current directory.')
+    parser.add_argument('--token',
+                        default=os.environ.get(TOKEN_ENV_VAR),
+                        help='Require requests to send this token, as '
+                             '"Authorization: Bearer <token>". Defaults to '
+                             f'the {TOKEN_ENV_VAR} environment variable.')
+    parser.add_argument('-v', '--verbose', dest='verbose_count',
+                        action='count', default=0,
+                        help='Each occurrence increases log verbosity.')
+    args = parser.parse_args(argv)
+
+    # Avoid a circular import.
+    from .nestler import set_log_level
+    set_log_level(args.verbose_count)
+
+    service = RenderService(concurrency=args.concurrency,
+                            queue_size=args.queue_size,
+                            timeout=args.timeout,
+                            max_uses=args.max_uses,
+                            out_root=args.out_root)
+    server = make_server(service, socket_path=args.socket, host=args.host,
+                         port=args.port, token=args.token)
+    # Stop as on Ctrl-C when asked to terminate, such as by a service
+    # manager. The server must be stopped from another thread.
+    signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(
+        target=server.shutdown).start())
+    where = args.socket or f'http://{args.host}:{args.port}'
+    logger.warning(f'Serving renders on {where}, press Ctrl-C to stop.')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        logger.warning('Stopping.')
+        server.server_close()
+        service.shutdown()
+        if args.socket is not None and os.path.exists(args.socket):
+            os.remove(args.socket)
@@ -1,6 +1,6 @@
 import argparse
 
-from ipykernel.kernelapp import IPKernelApp
+from .engine import PREAMBLE_EXTENSION
 
 DEFAULT_CONNECTION_FILE = '/tmp/kernel.json'
 
@@ -18,6 +18,8 @@ def main():
     )
     args = parser.parse_args()
 
+    from ipykernel.kernelapp import IPKernelApp
+
     kwargs = {}
     if args.debug:
         # Don't handle stdout, stderr specially, to let us keep using PDB.
@@ -25,6 +27,7 @@ def main():
 
     IPKernelApp.launch_instance(
         connection_file=args.connection_file,
+        extra_extensions=[PREAMBLE_EXTENSION],
         **kwargs,
     )
 
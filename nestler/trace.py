@@ -0,0 +1,108 @@
+"""Timing of the steps of a render, for `--trace`.
+
+Spans are written in the Chrome trace event format, which chrome://tracing
+and Perfetto can show. Spans are only recorded between `start` and `stop`.
+"""
+import json
+import os
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+
+Span = namedtuple('Span', ['name', 'category', 'start', 'duration',
+                           'thread_id', 'args'])
+
+SUMMARY_SIZE = 10
+
+
+class Tracer:
+
+    def __init__(self):
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def add(self, name, category, start, **args):
+        """Record a span from `start`, a `time.perf_counter` value, to now."""
+        duration = time.perf_counter() - start
+        with self._lock:
+            self.spans.append(Span(
+                name=name, category=category, start=start,
+                duration=duration, thread_id=threading.get_native_id(),
+                args=args,
+            ))
+
+    @contextmanager
+    def span(self, name, category, **args):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, category, start, **args)
+
+    def events(self):
+        t0 = min((span.start for span in self.spans), default=0)
+        pid = os.getpid()
+        return [
+            {
+                'name': span.name,
+                'cat': span.category,
+                # Complete events, with times in microseconds.
+                'ph': 'X',
+                'ts': (span.start - t0) * 1e6,
+                'dur': span.duration * 1e6,
+                'pid': pid,
+                'tid': span.thread_id,
+                'args': span.args,
+            }
+            for span in self.spans
+        ]
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': self.events(),
+                       'displayTimeUnit': 'ms'}, f)
+
+    def slowest(self, category, n=SUMMARY_SIZE):
+        spans = [span for span in self.spans if span.category == category]
+        return sorted(spans, key=lambda span: span.duration, reverse=True)[:n]
+
+
+_tracer = None
+
+
+def start():
+    global _tracer
+    _tracer = Tracer()
+    return _tracer
+
+
+def stop():
+    global _tracer
+    tracer, _tracer = _tracer, None
+    return tracer
+
+
+def add(name, category, start, **args):
+    if _tracer is not None:
+        _tracer.add(name, category, start, **args)
+
+
+@contextmanager
+def span(name, category, **args):
+    if _tracer is None:
+        yield
+    else:
+        with _tracer.span(name, category, **args):
+            yield
+
+
+def print_summary(tracer, n=SUMMARY_SIZE):
+    slowest = tracer.slowest('chunk', n=n)
+    if not slowest:
+        return
+    total = sum(span.duration for span in tracer.spans
+                if span.category == 'chunk')
+    print(f'Slowest chunks, of {total:.3f} s in all chunks:')
+    for span in slowest:
+        print(f'{span.duration:10.3f} s  {span.name}')
@@ -1,6 +1,63 @@
+import queue
+from concurrent.futures import ThreadPoolExecutor
+
+
 def trunc(s, lim=100):
     s = s.strip()
     if len(s) > lim:
         return s[:lim] + '...'
     else:
         return s
+
+
+class StreamAborted(Exception):
+    pass
+
+
+_END = object()
+
+
+def _iter_queue(q):
+    while True:
+        item = q.get()
+        if item is _END:
+            return
+        elif isinstance(item, StreamAborted):
+            raise item
+        yield item
+
+
+def _put(q, item, future):
+    # Don't wait on a consumer that has stopped.
+    while not future.done():
+        try:
+            q.put(item, timeout=0.1)
+        except queue.Full:
+            pass
+        else:
+            return
+
+
+def fan_out(items, consumers, queue_size=16):
+    """Pass each item of the iterable `items` to every consumer.
+
+    Each consumer is called on its own thread, with an iterator over the
+    items. At most `queue_size` items wait for each consumer, so items are
+    only produced as fast as they are consumed. If producing the items fails,
+    the consumers' iterators raise `StreamAborted`.
+    """
+    queues = [queue.Queue(maxsize=queue_size) for _ in consumers]
+    with ThreadPoolExecutor(max_workers=len(consumers)) as executor:
+        futures = [executor.submit(consumer, _iter_queue(q))
+                   for consumer, q in zip(consumers, queues)]
+        try:
+            for item in items:
+                for q, future in zip(queues, futures):
+                    _put(q, item, future)
+        except BaseException:
+            for q, future in zip(queues, futures):
+                _put(q, StreamAborted(), future)
+            raise
+        for q, future in zip(queues, futures):
+            _put(q, _END, future)
+        return [future.result() for future in futures]
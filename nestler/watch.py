@@ -0,0 +1,172 @@
+"""Render a document again each time it is saved, for `nestler --watch`.
+
+The kernel stays up between renders, and a journal records each render. After
+a change, the kernel's namespace is reset and restored from the last journal
+checkpoint before the first code part that differs, and code runs on from
+there; the parts before the checkpoint keep their results. Code that changes
+state, such as `x += 1`, so gives the same results as in a fresh render, and
+a failed render leaves nothing behind for the next. When only text changed,
+no code is run at all.
+"""
+import logging
+import os
+import tempfile
+import time
+
+from . import parseful as parse
+from . import output_routines
+from . import cache
+from . import execute
+from . import parse_cache
+from . import trace
+from .journal import Journal
+
+logger = logging.getLogger(__name__)
+
+POLL_SECONDS = 0.5
+
+# Renders are waited on, so checkpoint more readily than a journaled render.
+CHECKPOINT_SECONDS = 1
+
+
+def _code_positions(parts):
+    return [i for i, part in enumerate(parts)
+            if isinstance(part, (parse.CodeChunk, parse.InlineCode))]
+
+
+def reuse_results(old_parts, old_parts_evaled, new_parts):
+    """Return `new_parts` evaluated, if their code is that of `old_parts`.
+
+    Text is taken from `new_parts` and code results from `old_parts_evaled`.
+    Otherwise, return None.
+    """
+    old_positions = _code_positions(old_parts)
+    new_positions = _code_positions(new_parts)
+    if [old_parts[i] for i in old_positions] != [new_parts[i]
+                                                 for i in new_positions]:
+        return None
+    old_code_results = (old_parts_evaled[i] for i in old_positions)
+    return [
+        part if isinstance(part, str) else next(old_code_results)
+        for part in new_parts
+    ]
+
+
+def _evaluate(parts, client, global_options, doc_cache, journal,
+              pipeline_depth):
+    # Start from a fresh namespace, which the journal restores to its last
+    # checkpoint that the document still matches.
+    if pipeline_depth > 1:
+        # The kernel runs ahead of the results, so there is nowhere to
+        # checkpoint, and everything runs again.
+        execute.exec_kernel_function(client, 'nestler.preamble', '_reset')
+        return output_routines.evaluate_parts_with_client(
+            parts, client, global_options, doc_cache,
+            pipeline_depth=pipeline_depth,
+        )
+    journal.start([part for part in parts if not isinstance(part, str)],
+                  resume=True)
+    try:
+        execute.exec_kernel_function(client, 'nestler.preamble', '_reset')
+        parts_evaled = list(output_routines.iter_evaluated_parts(
+            parts, client, global_options, doc_cache, journal=journal,
+        ))
+    finally:
+        journal.close()
+    doc_cache.save_manifest()
+    return parts_evaled
+
+
+def _render(in_path, out_path_base, client, journal, last, cache_max_bytes,
+            cache_compress, incremental, explain, pipeline_depth,
+            max_output_lines, max_output_bytes, parse_cache_path):
+    # Avoid a circular import.
+    from . import nestler
+
+    with open(in_path) as in_file, trace.span('read and parse', 'parse'):
+        if parse_cache_path is None:
+            header, parts = parse.parse(in_file.read())
+        else:
+            header, parts = parse_cache.ParseCache(
+                parse_cache_path).parse_stream(in_file)
+            parts = list(parts)
+    global_options = nestler.get_global_options(
+        incremental=incremental,
+        out_path_base=out_path_base,
+        max_output_lines=max_output_lines,
+        max_output_bytes=max_output_bytes,
+    )
+    output_routine_map = nestler.get_output_routine_map(header)
+
+    doc_cache = nestler.get_doc_cache(parts, global_options, out_path_base,
+                                      cache_max_bytes=cache_max_bytes,
+                                      cache_compress=cache_compress)
+    parts_evaled = None
+    if last is not None:
+        parts_evaled = reuse_results(*last, parts)
+    if parts_evaled is not None:
+        logger.info('No code changed, rendering without running any.')
+        for node in doc_cache.nodes:
+            doc_cache.runs[node.index] = 'reused'
+    else:
+        parts_evaled = _evaluate(parts, client, global_options, doc_cache,
+                                 journal, pipeline_depth)
+    if explain:
+        nestler.print_explanation(doc_cache)
+    if output_routine_map:
+        nestler.render_outputs(header, parts_evaled, out_path_base,
+                               output_routine_map)
+    return parts, parts_evaled
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        # Some editors save by replacing the file, so it can briefly vanish.
+        return None
+
+
+def watch(in_path, out_path_base, connection_file=None,
+          cache_max_bytes=cache.DEFAULT_MAX_BYTES, cache_compress=False,
+          incremental=False, explain=False, pipeline_depth=1,
+          max_output_lines=None, max_output_bytes=None,
+          parse_cache_path=None, poll_seconds=POLL_SECONDS):
+    # The parts and evaluated parts of the last successful render.
+    last = None
+    rendered_mtime = None
+    with output_routines.document_client(
+            connection_file=connection_file) as client, \
+            tempfile.TemporaryDirectory(prefix='nestler-watch-') as tmp_dir:
+        journal = Journal(os.path.join(tmp_dir, 'journal'),
+                          checkpoint_seconds=CHECKPOINT_SECONDS,
+                          compress=cache_compress)
+        logger.warning(f'Watching "{in_path}", press Ctrl-C to stop.')
+        try:
+            while True:
+                mtime = _mtime(in_path)
+                if mtime is not None and mtime != rendered_mtime:
+                    rendered_mtime = mtime
+                    start = time.perf_counter()
+                    try:
+                        last = _render(
+                            in_path, out_path_base, client, journal, last,
+                            cache_max_bytes=cache_max_bytes,
+                            cache_compress=cache_compress,
+                            incremental=incremental,
+                            explain=explain,
+                            pipeline_depth=pipeline_depth,
+                            max_output_lines=max_output_lines,
+                            max_output_bytes=max_output_bytes,
+                            parse_cache_path=parse_cache_path,
+                        )
+                    except Exception:
+                        logger.exception('Render failed, waiting for the '
+                                         'next change.')
+                    else:
+                        duration = time.perf_counter() - start
+                        logger.warning(f'Rendered "{in_path}" in '
+                                       f'{duration:.2f} s.')
+                time.sleep(poll_seconds)
+        except KeyboardInterrupt:
+            logger.warning('Stopped watching.')
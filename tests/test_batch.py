@@ -0,0 +1,31 @@
+from nestler import batch
+
+DOC = '''\
+---
+output:
+    md_document: {{}}
+    github_document: {{}}
+---
+
+Document {0} has `python {0} + 1`.
+'''
+
+
+def _render_dir(in_dir):
+    results = batch.render_files(batch.find_inputs([str(in_dir)]), jobs=1)
+    assert [result.error for result in results] == [None] * len(results)
+    return [result.in_path for result in results]
+
+
+def test_rendering_a_directory_again_skips_its_outputs(tmp_path):
+    for i in range(2):
+        (tmp_path / f'doc{i}.md').write_text(DOC.format(i))
+    in_paths = [str(tmp_path / f'doc{i}.md') for i in range(2)]
+
+    assert _render_dir(tmp_path) == in_paths
+    assert _render_dir(tmp_path) == in_paths
+    assert sorted(path.name for path in tmp_path.glob('*.md')) == [
+        'doc0.gfm.md', 'doc0.md', 'doc0.out.md',
+        'doc1.gfm.md', 'doc1.md', 'doc1.out.md',
+    ]
+    assert 'Document 1 has 2.' in (tmp_path / 'doc1.out.md').read_text()
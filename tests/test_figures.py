@@ -0,0 +1,14 @@
+import os
+
+from nestler import output_routines
+from nestler.output_routines import RenderOption
+
+
+def test_figure_store_is_relative_to_the_document(tmp_path, monkeypatch):
+    doc_dir = tmp_path / 'docs'
+    doc_dir.mkdir()
+    monkeypatch.chdir(tmp_path)
+    store = output_routines.get_figure_store(
+        {RenderOption.figure_store: 'figs'}, os.path.join('docs', 'report'),
+    )
+    assert store.path == str(doc_dir / 'figs')
@@ -0,0 +1,65 @@
+import pytest
+
+from nestler import nestler
+
+DOC = '''\
+---
+output:
+    md_document: {{}}
+---
+
+Some text.
+
+```{{python a}}
+with open({log!r}, 'a') as f:
+    f.write('a\\n')
+x = 1
+```
+
+More text, with `python x`.
+
+```{{python b}}
+with open({log!r}, 'a') as f:
+    f.write('b\\n')
+x += 1
+```
+
+```{{python c}}
+with open({log!r}, 'a') as f:
+    f.write('c\\n')
+import os
+if not os.path.exists({flag!r}):
+    raise RuntimeError('Not yet')
+print(x)
+```
+'''
+
+
+def _render(in_path, out_path_base, **kwargs):
+    with open(in_path) as in_stream:
+        nestler.run(in_stream, out_path_base, connection_file=None,
+                    journal=True, checkpoint_every=1, **kwargs)
+
+
+@pytest.mark.parametrize('use_parse_cache', [False, True])
+def test_resume_runs_chunks_after_checkpoint(tmp_path, use_parse_cache):
+    log_path = tmp_path / 'runs.log'
+    flag_path = tmp_path / 'ok'
+    in_path = tmp_path / 'doc.md'
+    in_path.write_text(DOC.format(log=str(log_path), flag=str(flag_path)))
+    out_path_base = str(tmp_path / 'doc')
+    kwargs = {}
+    if use_parse_cache:
+        kwargs['parse_cache_path'] = str(tmp_path / 'parsed')
+
+    with pytest.raises(ValueError):
+        _render(in_path, out_path_base, **kwargs)
+    flag_path.touch()
+    _render(in_path, out_path_base, resume=True, **kwargs)
+
+    # Only the chunk after the last checkpoint ran again.
+    assert log_path.read_text().split() == ['a', 'b', 'c', 'c']
+    with open(f'{out_path_base}.out.md') as f:
+        out = f.read()
+    assert 'More text, with 1.' in out
+    assert '"2"' in out